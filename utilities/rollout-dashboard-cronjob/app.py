@@ -1,13 +1,156 @@
 from typing import BinaryIO, List
 import requests
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from dateutil import tz
 import pytz
 from dateutil import parser
+from dateutil.relativedelta import relativedelta
 import time
 import os
+import json
+import hashlib
 import psycopg2
+from psycopg2 import pool, extras, errors, extensions
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from contextlib import contextmanager
+import functools
+import argparse
+import re
+import tempfile
+import signal
+from decimal import Decimal
 
+# ijson parses the projectmodule master zone by zone, without it the response is parsed in one piece
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# kafka-python is only needed for ROLLOUT_MODE=stream with EVENT_STREAM_BROKER=kafka
+try:
+    from kafka import KafkaConsumer
+except ImportError:
+    KafkaConsumer = None
+
+# numpy is only needed by the anomaly detection after a run, without it the check is skipped
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# run instrumentation: calls, wall time, returned rows and errors per metric function and per tenant,
+# reset at the start of process() and reported by writeRunReport() at the end of it
+runMetrics = {}
+tenantMetrics = {}
+runSummary = {}
+metricsLock = threading.Lock()
+metricContext = threading.local()
+
+@contextmanager
+def recordMetric(metricName):
+    previousMetric = getattr(metricContext, 'metricName', None)
+    metricContext.metricName = metricName
+    record = {"rows": 0}
+    start = time.time()
+    try:
+        yield record
+    except Exception:
+        countError()
+        raise
+    finally:
+        elapsed = time.time() - start
+        metricContext.metricName = previousMetric
+        with metricsLock:
+            metric = runMetrics.setdefault(metricName, {"calls": 0, "seconds": 0.0, "rows": 0, "errors": 0})
+            metric["calls"] += 1
+            metric["seconds"] += elapsed
+            metric["rows"] += record["rows"]
+
+@contextmanager
+def recordTenant(tenantId):
+    metricContext.tenantId = tenantId
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        metricContext.tenantId = None
+        with metricsLock:
+            tenantMetrics.setdefault(tenantId, {"seconds": 0.0, "errors": 0})["seconds"] += elapsed
+
+def instrumented(function=None, metricNameArgument=False):
+    # record the decorated function under its name, or under its first argument for the generic all tenant metric query
+    def decorate(function):
+        @functools.wraps(function)
+        def instrumentedFunction(*args, **kwargs):
+            metricName = args[0] if metricNameArgument else function.__name__
+            with recordMetric(metricName) as record:
+                result = function(*args, **kwargs)
+                if isinstance(result, (dict, list)):
+                    record["rows"] = len(result)
+                elif result is not None:
+                    record["rows"] = 1
+            return result
+        return instrumentedFunction
+    return decorate(function) if function else decorate
+
+def countError():
+    with metricsLock:
+        metricName = getattr(metricContext, 'metricName', None)
+        if metricName:
+            runMetrics.setdefault(metricName, {"calls": 0, "seconds": 0.0, "rows": 0, "errors": 0})["errors"] += 1
+        tenantId = getattr(metricContext, 'tenantId', None)
+        if tenantId:
+            tenantMetrics.setdefault(tenantId, {"seconds": 0.0, "errors": 0})["errors"] += 1
+
+def logException(exception, *message):
+    # print a caught exception and count it against the metric function and tenant it happened in
+    print(*(message or ("Exception occurred while connecting to the database",)))
+    print(exception)
+    countError()
+
+def resetRunMetrics():
+    with metricsLock:
+        runMetrics.clear()
+        tenantMetrics.clear()
+        runSummary.clear()
+        del poolWaitTimes[:]
+
+# run time budget started by process() from RUN_TIME_BUDGET_SECONDS. metric queries are not started once it is used up
+# and every query gets a statement_timeout of METRIC_STATEMENT_TIMEOUT_SECONDS capped to the remaining budget, the cells
+# left empty are carried forward from the published dashboard and listed in stale_columns
+runBudget = {"deadline": None}
+
+def startRunBudget():
+    budgetSeconds = float(os.getenv('RUN_TIME_BUDGET_SECONDS', '0'))
+    runBudget['deadline'] = time.time() + budgetSeconds if budgetSeconds > 0 else None
+
+def budgetExhausted():
+    if runBudget['deadline'] is None or time.time() < runBudget['deadline']:
+        return False
+    runSummary['budgetExhausted'] = True
+    return True
+
+def getStatementTimeout():
+    # statement_timeout in milliseconds, 0 leaves the queries unbounded
+    timeout = float(os.getenv('METRIC_STATEMENT_TIMEOUT_SECONDS', '900')) * 1000
+    if runBudget['deadline'] is not None:
+        remaining = max(1, (runBudget['deadline'] - time.time()) * 1000)
+        timeout = min(timeout, remaining) if timeout > 0 else remaining
+    return int(timeout)
+
+def getRequestTimeout():
+    # timeout in seconds of an mdms call, MDMS_TIMEOUT_SECONDS capped to the remaining budget like the statement_timeout,
+    # None leaves the call unbounded
+    timeout = float(os.getenv('MDMS_TIMEOUT_SECONDS', '60'))
+    if runBudget['deadline'] is not None:
+        remaining = max(1, runBudget['deadline'] - time.time())
+        timeout = min(timeout, remaining) if timeout > 0 else remaining
+    return timeout if timeout > 0 else None
+
+@instrumented
 def getGPWSCHeirarchy():
 
         # call the projectmodule mdms for each unique tenant which would return the array of unique villages( i.e tenantid) along with the respectie
@@ -44,529 +187,2484 @@ def getGPWSCHeirarchy():
                 }
             }
             
-            response = requests.post(url+'egov-mdms-service/v1/_search', json=requestData)
-            
-            responseData = response.json()
-            projectModuleList = responseData['MdmsRes']['tenant']['projectmodule']
-            dataList = []
-           
-            for zoneData in projectModuleList:
-                circle = zoneData['circle']
-                for circleData in circle:
-                    division = circleData['division']
-                    for divisionData in division:
-                        subDivision = divisionData['subdivision']
-                        for subdivisionData in subDivision:
-                            section = subdivisionData['section']
-                            for sectionData in section:
-                                project = sectionData['project']
-                                for projectData in project:
-                                    tenantId = projectData['name'].replace(" ", "").lower()
-                                    formatedTenantId= "pb."+tenantId;
-                                    obj1 = {
-                                                "tenantId":formatedTenantId,
-                                                "zone":zoneData['name'],
-                                                "circle":circleData['name'],
-                                                "division":divisionData['name'],
-                                                "subdivision":subdivisionData['name'],
-                                                "section":sectionData['name'],
-                                                "projectcode":projectData['code']
-                                           }
-                                    
-                                    dataList.append(obj1)
-            print("heirarchy collected")
-            #return [{"tenantId":"pb.lodhipur", "projectcode":"1234","zone":"zone1","circle":"Circle1","division":"Dvisiion1","subdivision":"SD1", "section":"sec1"}]
-            return dataList
+            timeout = getRequestTimeout()
+            response = mdmsSession.post(url+'egov-mdms-service/v1/_search', json=requestData, stream=True, timeout=timeout)
+            if response.status_code != 200:
+                raise Exception("projectmodule search failed with status " + str(response.status_code))
+            contentHash, body = spoolResponse(response, timeout)
         except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-
-def getConsumerCreated(tenantId):
-        # query the postgresql db to get the total count of total connection in the given tenant till date  
-        print("consumer created count returned")
-        try:                          
-            connection = getConnection()
-            cursor = connection.cursor()
-             
-            CONSUMER_CREATED_COUNT_QUERY = "select count(*) from eg_ws_connection where status = 'Active' and tenantid = '"+tenantId+"'"
-            cursor.execute(CONSUMER_CREATED_COUNT_QUERY)
-            result = cursor.fetchone()
-            print(result[0])
-            return result[0]
-         
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
+            logException(exception)
+            return getFallbackHeirarchy(readJsonCache(getHeirarchyCacheFile()))
         
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
+        with body:
+            cacheFile = getHeirarchyCacheFile()
+            cacheData = readJsonCache(cacheFile)
+            if cacheData.get('contentHash') == contentHash:
+                print("heirarchy unchanged, using the cached list")
+                runSummary['heirarchyCached'] = True
+                return loadCachedHeirarchy(cacheData)
+            
+            try:
+                dataList = list(iterHeirarchyRecords(parseProjectModule(body)))
+                if not dataList:
+                    raise Exception("no projectmodule villages in the mdms response")
+            except Exception as exception:
+                logException(exception)
+                return getFallbackHeirarchy(cacheData)
+        print("heirarchy collected")
+        if cacheData.get('tenants'):
+            runSummary['heirarchyChanges'] = diffHeirarchy(loadCachedHeirarchy(cacheData), dataList)
+        writeJsonCache(cacheFile, {"contentHash": contentHash, "fetchedAt": time.time(), "tenants": dataList})
+        return dataList
+
+# the flattened heirarchy is kept at HEIRARCHY_CACHE_FILE with the content hash of the projectmodule response it came
+# from, an unchanged response is not parsed again and a changed one is compared with the cached list
+def getHeirarchyCacheFile():
+    return os.getenv('HEIRARCHY_CACHE_FILE', '/tmp/rollout-dashboard-heirarchy-cache.json')
+
+# one village of the projectmodule master, in the column order of ROLLOUT_HEIRARCHY_COLUMNS
+HeirarchyRecord = namedtuple('HeirarchyRecord', ['tenantId', 'projectcode', 'zone', 'circle', 'division', 'subdivision', 'section'])
+
+def getFallbackHeirarchy(cacheData):
+    # the heirarchy changes rarely, a failed mdms call or a response without villages runs with the last list seen
+    if cacheData.get('tenants'):
+        print("heirarchy could not be fetched, using the cached list of", datetime.fromtimestamp(cacheData['fetchedAt']).isoformat())
+        return loadCachedHeirarchy(cacheData)
+    return None
+
+def loadCachedHeirarchy(cacheData):
+    # rows are cached as lists, caches written before HeirarchyRecord hold dicts
+    return [HeirarchyRecord(**row) if isinstance(row, dict) else HeirarchyRecord(*row) for row in cacheData['tenants']]
+
+def spoolResponse(response, timeout=None):
+    # hash the response body while copying it to a spooled temporary file, bodies above HEIRARCHY_SPOOL_BYTES go to
+    # disk so the raw master is never held in memory as a whole. the request timeout bounds each read, a body trickling
+    # in for longer than the timeout in total is given up as well
+    hasher = hashlib.sha256()
+    body = tempfile.SpooledTemporaryFile(max_size=int(os.getenv('HEIRARCHY_SPOOL_BYTES', str(8 * 1024 * 1024))))
+    deadline = time.time() + timeout if timeout else None
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        if deadline and time.time() > deadline:
+            body.close()
+            raise Exception("projectmodule response not read within " + str(timeout) + " seconds")
+        hasher.update(chunk)
+        body.write(chunk)
+    body.seek(0)
+    return hasher.hexdigest(), body
+
+def parseProjectModule(body):
+    # zones of the projectmodule master one at a time with ijson, the whole document at once without it
+    if ijson:
+        return ijson.items(body, 'MdmsRes.tenant.projectmodule.item', use_float=True)
+    return json.load(body)['MdmsRes']['tenant']['projectmodule']
+
+def iterHeirarchyRecords(projectModuleList):
+    # one record per project of the zone / circle / division / subdivision / section tree, yielded as the zones come in
+    for zoneData in projectModuleList:
+        for circleData in zoneData['circle']:
+            for divisionData in circleData['division']:
+                for subdivisionData in divisionData['subdivision']:
+                    for sectionData in subdivisionData['section']:
+                        for projectData in sectionData['project']:
+                            yield HeirarchyRecord(tenantId="pb." + projectData['name'].replace(" ", "").lower(),
+                                                  projectcode=projectData['code'],
+                                                  zone=zoneData['name'],
+                                                  circle=circleData['name'],
+                                                  division=divisionData['name'],
+                                                  subdivision=subdivisionData['name'],
+                                                  section=sectionData['name'])
+
+def diffHeirarchy(previousTenants, tenants):
+    # villages added, removed and moved to another project / section since the cached heirarchy, by tenantid.
+    # the first entry of a duplicated tenant counts, the same one removeDuplicateTenants() keeps
+    previousById = {}
+    for tenant in previousTenants:
+        previousById.setdefault(tenant.tenantId, tenant)
+    currentById = {}
+    for tenant in tenants:
+        currentById.setdefault(tenant.tenantId, tenant)
+    
+    changes = {"added": sorted(set(currentById) - set(previousById)),
+               "removed": sorted(set(previousById) - set(currentById)),
+               "moved": sorted(tenantId for tenantId in set(currentById) & set(previousById) if currentById[tenantId] != previousById[tenantId])}
+    for tenantId in changes["added"]:
+        print("heirarchy: village added", currentById[tenantId])
+    for tenantId in changes["removed"]:
+        print("heirarchy: village removed", previousById[tenantId])
+    for tenantId in changes["moved"]:
+        print("heirarchy: village moved", previousById[tenantId], "->", currentById[tenantId])
+    print("heirarchy changed:", len(changes["added"]), "added,", len(changes["removed"]), "removed,", len(changes["moved"]), "moved")
+    return changes
+
+def fetchBillingSlabs(tenantId):
+        # make mdms call to get the WCBillingSlab master of the given tenant, the keep-alive session is reused across calls
+        url = os.getenv('API_URL')
+    
+        requestData = {
+            "RequestInfo": {
+                "apiId": "mgramseva-common",
+                "ver": 0.01,
+                "ts": "",
+                "action": "_search",
+                "did": 1,
+                "key": "",
+                "msgId": ""
+             },
+            "MdmsCriteria": {
+                "tenantId": tenantId,
+                "moduleDetails": [
+                    {
+                        "moduleName": "ws-services-calculation",
+                        "masterDetails": [
+                            {
+                                "name": "WCBillingSlab"
+                            }
+                        ]
+                    }
+                ]
+            }
+        }
+
+        response = mdmsSession.post(url+'egov-mdms-service/v1/_search', json=requestData, timeout=getRequestTimeout())
+    
+        responseData = response.json()
+        return responseData['MdmsRes']['ws-services-calculation']['WCBillingSlab']
+
+def getContentHash(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
 
+@instrumented
 def getRateMasters(tenantId):
         # make mdms call to get the rate unique rate masters i.e billig slab . count the unique billing slabs and return the number
+        # counts loaded by loadBillingSlabCounts() for the run are served from memory
         print("Rate master count returned")
+        with billingSlabLock:
+            if tenantId in billingSlabCounts:
+                return billingSlabCounts[tenantId]
+        if budgetExhausted():
+            return None
         try:
-            
-                
-            url = os.getenv('API_URL')
-        
-            requestData = {
-                "RequestInfo": {
-                    "apiId": "mgramseva-common",
-                    "ver": 0.01,
-                    "ts": "",
-                    "action": "_search",
-                    "did": 1,
-                    "key": "",
-                    "msgId": ""
-                 },
-                "MdmsCriteria": {
-                    "tenantId": tenantId,
-                    "moduleDetails": [
-                        {
-                            "moduleName": "ws-services-calculation",
-                            "masterDetails": [
-                                {
-                                    "name": "WCBillingSlab"
-                                }
-                            ]
-                        }
-                    ]
-                }
-            }
-
-            response = requests.post(url+'egov-mdms-service/v1/_search', json=requestData)
-        
-            responseData = response.json()
-            wcBillingSlabList = responseData['MdmsRes']['ws-services-calculation']['WCBillingSlab']
-          
+            wcBillingSlabList = fetchBillingSlabs(tenantId)
+            with billingSlabLock:
+                billingSlabCounts[tenantId] = len(wcBillingSlabList)
             return len(wcBillingSlabList)
         except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-  
-def getLastDemandDate(tenantId):
-    # make db call to get the last demand generated date for the given tenant
-        print("last demand date returned")
-        try:
-            connection = getConnection()
-            cursor = connection.cursor()  
-            
-            LAST_DEMAND_DATE = "select createdtime from egbs_demand_v1 where tenantid = '"+tenantId+"'"+" order by createdtime desc LIMIT 1"
-            
-            cursor.execute(LAST_DEMAND_DATE)
-            result = cursor.fetchone()
-                      
-            formatedDate = datetime.fromtimestamp(result[0]/1000.0)
-            print(formatedDate)
-            
-            return formatedDate
-            
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception) 
-        
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
-        
-def getCollectionsMade(tenantId):
-        # make db call with query to get the collections made in the current date in the given tenant
-        #should be till date not current date. 
-        print("collections made returned")
-        try:
-            connection = getConnection()
-            cursor = connection.cursor()
-          
-            COLLECTION_MADE_TILL_THE_CURRENT_DATE_QUERY = "select sum(amountpaid) from egcl_paymentdetail where businessservice = 'WS' and tenantid = '"+tenantId+"'"
-              
-            cursor.execute(COLLECTION_MADE_TILL_THE_CURRENT_DATE_QUERY)
-            result = cursor.fetchone()
-            print(result[0])
-            return result[0]
-        
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-        
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
-        
-def getCollectionsMadeOnline(tenantId):
-        # make db call with query to get the collections made in the current date of type online in the given tenant, as of now no data exists but write the query
-        #should be till date not current date. 
-       
-        print("collections made online returned")
-        try:
-            connection = getConnection()
-            cursor = connection.cursor()
-            
-            COLLECTION_MADE_TILL_THE_CURRENT_DATE_ONLINE_QUERY = "select sum(pd.amountpaid) from egcl_payment p join egcl_paymentdetail pd on p.id = pd.paymentid where pd.businessservice = 'WS' and p.tenantid = '"+tenantId+"'" + " and p.paymentmode = 'ONLINE' "
-        
-            cursor.execute(COLLECTION_MADE_TILL_THE_CURRENT_DATE_ONLINE_QUERY)
-            result = cursor.fetchone()
-            print(result[0])
-            return result[0]
-            
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-        
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
+            logException(exception)
 
-def getLastCollectionDate(tenantId):
-        # make db call to get the last collection date for the given tenant    
-        print("lat collection date returned")
-        try:
-            connection = getConnection()
-            cursor = connection.cursor()
-            
-            LAST_COLLECTION_DATE_QUERY = "select createdtime from egcl_paymentdetail where businessservice = 'WS' and tenantid = '"+tenantId+"'" + " order by createdtime desc limit 1" 
-            
-            cursor.execute(LAST_COLLECTION_DATE_QUERY)
-            result = cursor.fetchone()
-            
-            formatedDate = datetime.fromtimestamp(result[0]/1000.0)
-            
-            print(formatedDate)
-            return formatedDate
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-            
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
+# billing slab counts of the current run, filled once by loadBillingSlabCounts(). the on disk cache at BILLING_SLAB_CACHE_FILE
+# keeps per tenant counts with the content hash of the slab master for BILLING_SLAB_CACHE_TTL_HOURS, mount it on a
+# volume to share it between cronjob runs
+mdmsSession = requests.Session()
+billingSlabCounts = {}
+billingSlabLock = threading.Lock()
+
+def readJsonCache(cacheFile):
+    try:
+        with open(cacheFile) as cache:
+            return json.load(cache)
+    except (IOError, ValueError):
+        return {}
 
-def getExpenseBillEntered(tenantId):
-        # make db call to get the total no of expenses entered  in the give tenant on the current date
-        #total till date not current date
+def writeJsonCache(cacheFile, cacheData):
+    try:
+        temporaryFile = cacheFile + '.tmp'
+        with open(temporaryFile, 'w') as cache:
+            json.dump(cacheData, cache)
+        os.replace(temporaryFile, cacheFile)
+    except IOError as exception:
+        print("cache could not be written", cacheFile)
+        print(exception)
 
-        print("expense bill entered returned")
+@instrumented
+def loadBillingSlabCounts(tenants):
+    # load the billing slab count of every tenant once per run. BILLING_SLAB_STATE_LEVEL=true first tries a single
+    # state level mdms search and counts slabs per their tenantId attribute, tenants not covered there are read from the
+    # disk cache while their entry is fresh and fetched one by one over the shared session otherwise
+    cacheFile = os.getenv('BILLING_SLAB_CACHE_FILE', '/tmp/rollout-dashboard-billing-slab-cache.json')
+    cacheTtl = float(os.getenv('BILLING_SLAB_CACHE_TTL_HOURS', '24')) * 3600
+    now = time.time()
+    cacheData = readJsonCache(cacheFile)
+    billingSlabCounts.clear()
+    tenantIds = [tenant.tenantId for tenant in tenants]
+    
+    if os.getenv('BILLING_SLAB_STATE_LEVEL', 'false').lower() == 'true':
         try:
-            connection = getConnection()
-            cursor = connection.cursor()
-            
-            TOTAL_NO_EXPENSES_TILL_DATE = "select count(*) from eg_echallan where tenantid = '"+tenantId+"'"
-            
-            cursor.execute(TOTAL_NO_EXPENSES_TILL_DATE)
-            result = cursor.fetchone()
-            print(result[0])
-            return result[0]
-        
+            slabsByTenant = {}
+            for slab in fetchBillingSlabs(os.getenv('TENANT_ID')):
+                if slab.get('tenantId'):
+                    slabsByTenant.setdefault(slab['tenantId'], []).append(slab)
+            for tenantId in tenantIds:
+                if tenantId in slabsByTenant:
+                    billingSlabCounts[tenantId] = len(slabsByTenant[tenantId])
+                    cacheData[tenantId] = {"count": len(slabsByTenant[tenantId]), "contentHash": getContentHash(slabsByTenant[tenantId]), "fetchedAt": now}
+            print("billing slabs of", len(slabsByTenant), "tenants loaded from state level master")
         except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-        
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
-        
-def getLastExpTransactionDate(tenantId):
-        # make db call to get the latest expense bill entered date in that given tenant
-        print("expense transaction date")
+            logException(exception, "Exception occurred while fetching state level billing slabs")
+    
+    fetchedCount = 0
+    for tenantId in tenantIds:
+        if tenantId in billingSlabCounts:
+            continue
+        cacheEntry = cacheData.get(tenantId)
+        if cacheEntry and now - cacheEntry['fetchedAt'] < cacheTtl:
+            billingSlabCounts[tenantId] = cacheEntry['count']
+            continue
+        # the tenants left without a count are carried forward as stale cells
+        if budgetExhausted():
+            print("run time budget used up, billing slabs of the remaining tenants are not fetched")
+            break
         try:
-            connection = getConnection()
-            cursor = connection.cursor()
-            LAT_EXP_BILL_DATE = "select createdtime from eg_echallan where tenantid = '"+tenantId+"'" +" order by createdtime desc limit 1"
-        
-            cursor.execute(LAT_EXP_BILL_DATE)
-            result = cursor.fetchone()
-            formatedDate = datetime.fromtimestamp(result[0]/1000.0)
-            print(formatedDate)
-            return formatedDate
-        
+            wcBillingSlabList = fetchBillingSlabs(tenantId)
         except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-        
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
+            logException(exception, "Exception occurred while fetching billing slabs of", tenantId)
+            continue
+        fetchedCount += 1
+        contentHash = getContentHash(wcBillingSlabList)
+        if cacheEntry and cacheEntry['contentHash'] != contentHash:
+            print("billing slabs changed for", tenantId)
+        billingSlabCounts[tenantId] = len(wcBillingSlabList)
+        cacheData[tenantId] = {"count": len(wcBillingSlabList), "contentHash": contentHash, "fetchedAt": now}
+    
+    print("billing slab counts loaded, mdms calls made:", fetchedCount)
+    writeJsonCache(cacheFile, cacheData)
+  
+# declarative registry of the dashboard KPIs. a metric names its output column, the source it is computed from, the
+# aggregate (count, sum or max), the aggregated expression and an optional FILTER condition; a source gives the FROM
+# clause with the scanned table aliased t, the tenant column, a condition applied to every metric of the source and the
+# (watermark name, createdtime column) pairs used by the incremental watermarks, the first one being the default of its
+# metrics. compileSourceQuery() merges all metrics of a source into one scan with conditional aggregation, so a new KPI
+# on an existing source adds no extra pass over the table. a source with a breakdown column is grouped by tenant and that
+# column first, its breakdown metrics return a JSON object of the summed expression per value of the column.
+# max metrics aggregate createdtime (epoch millis) and are returned as dates. conditions must not contain a literal %
+# sources run in the order of their most important metric (priority 1 first), so a run that hits its time budget has
+# the core adoption numbers fresh and carries the others forward
+MetricSource = namedtuple('MetricSource', ['name', 'fromClause', 'tenantColumn', 'condition', 'watermarks', 'breakdownColumn'],
+                          defaults=(None,))
+Metric = namedtuple('Metric', ['column', 'source', 'aggregate', 'expression', 'filter', 'watermark', 'priority'], defaults=(None, 2))
 
+METRIC_SOURCES = [
+    MetricSource('eg_ws_connection', "eg_ws_connection t", "t.tenantid", None, [('eg_ws_connection', "t.createdtime")]),
+    # the demand tables are the largest ones, demands and their advance / penalty details are read in a single join
+    # pass. only the two taxheads are joined so a demand contributes at most one row per taxhead, and the details keep
+    # their own watermark since penalties are added to existing demands
+    MetricSource('egbs_demand_v1',
+                 "egbs_demand_v1 t left join egbs_demanddetail_v1 dd on dd.demandid = t.id and dd.taxheadcode in ('WS_ADVANCE_CARRYFORWARD', 'WS_TIME_PENALTY')",
+                 "t.tenantid", None, [('egbs_demand_v1', "t.createdtime"), ('egbs_demanddetail_v1', "dd.createdtime")]),
+    # payments are read once for the total and online collection and the collection per payment mode
+    MetricSource('egcl_paymentdetail', "egcl_paymentdetail t left join egcl_payment p on p.id = t.paymentid", "t.tenantid", "t.businessservice = 'WS'",
+                 [('egcl_paymentdetail', "t.createdtime")], "p.paymentmode"),
+    MetricSource('eg_echallan', "eg_echallan t", "t.tenantid", None, [('eg_echallan', "t.createdtime")]),
+    MetricSource('eg_ws_feedback', "eg_ws_feedback t", "t.tenantid", None, [('eg_ws_feedback', "t.createdtime")]),
+    # employees have no createdtime watermark, incremental runs recompute this source in full
+    MetricSource('eg_userrole_v1', "eg_user u join eg_userrole_v1 t on u.id = t.user_id", "t.role_tenantid",
+                 "u.active = 't' and u.type = 'EMPLOYEE' and t.role_code = 'EMPLOYEE'", [])
+]
 
-def getNoOfBillsPaid(tenantId):
-        # make db call to get total no of expenses bills marked as paid till current date.
-        print("No of bill paid")
-        try:
-            connection = getConnection()
-            cursor = connection.cursor()
-            
-            TOTAL_EXPENSES_BILL_MARKED_PAID = "select count(*) from eg_echallan where tenantid = '"+tenantId+"'"+" and applicationstatus = 'PAID' "
-            
-            cursor.execute(TOTAL_EXPENSES_BILL_MARKED_PAID)
-            result = cursor.fetchone()
-            print(result[0])
-            return result[0]
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-            
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
-                
-def getTotalDemandRaised(tenantId):
-        # make db call to get the total no of demand raised till date for ws   
-        print("lat collection date returned")
-        try:
-            connection = getConnection()
-            cursor = connection.cursor()
-            
-            TOTAL_DEMANDS = "select count(*) from egbs_demand_v1 where businessservice = 'WS' and status = 'ACTIVE' and tenantid = '"+tenantId+"'" 
-            
-            cursor.execute(TOTAL_DEMANDS)
-            result = cursor.fetchone()
-            print(result[0])
-            return result[0]
-            
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-            
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
+METRIC_REGISTRY = [
+    Metric('consumer_created_count', 'eg_ws_connection', 'count', '*', "t.status = 'Active'", priority=1),
+    Metric('collection_till_date', 'egcl_paymentdetail', 'sum', 't.amountpaid', None, priority=1),
+    Metric('collection_till_date_online', 'egcl_paymentdetail', 'sum', 't.amountpaid', "p.paymentmode = 'ONLINE'"),
+    Metric('collection_by_payment_mode', 'egcl_paymentdetail', 'breakdown', 't.amountpaid', None),
+    Metric('expense_count', 'eg_echallan', 'count', '*', None),
+    Metric('paid_status_expense_bill_count', 'eg_echallan', 'count', '*', "t.applicationstatus = 'PAID'"),
+    Metric('demands_till_date_count', 'egbs_demand_v1', 'count', 'distinct t.id', "t.businessservice = 'WS' and t.status = 'ACTIVE'", priority=1),
+    Metric('ratings_count', 'eg_ws_feedback', 'count', '*', None, priority=3),
+    Metric('active_users_count', 'eg_userrole_v1', 'count', '*', None, priority=3),
+    Metric('total_advance', 'egbs_demand_v1', 'sum', 'dd.taxamount', "t.status = 'ACTIVE' and dd.taxheadcode = 'WS_ADVANCE_CARRYFORWARD'",
+           'egbs_demanddetail_v1'),
+    Metric('total_penalty', 'egbs_demand_v1', 'sum', 'dd.taxamount', "t.status = 'ACTIVE' and dd.taxheadcode = 'WS_TIME_PENALTY'",
+           'egbs_demanddetail_v1')
+]
 
-def getRatingCount(tenantId):
-        # make db call to get the total no of ratings   
-        print("no of ratings")
-        try:
-            connection = getConnection()
-            cursor = connection.cursor()
-            
-            TOTAL_RATINGS = "select count(*) from eg_ws_feedback where tenantid = '"+tenantId+"'" 
-            
-            cursor.execute(TOTAL_RATINGS)
-            result = cursor.fetchone()
-            print(result[0])
-            return result[0]
-            
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-            
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
-                
-def getLastRatingDate(tenantId):
-        # make db call to get the last rating date entered date in that given tenant
-        print("last rating date geiven")
-        try:
-            connection = getConnection()
-            cursor = connection.cursor()
-            LAST_RATING_DATE = "select createdtime from eg_ws_feedback where tenantid = '"+tenantId+"'" +" order by createdtime desc limit 1"
-        
-            cursor.execute(LAST_RATING_DATE)
-            result = cursor.fetchone()
-            formatedDate = datetime.fromtimestamp(result[0]/1000.0)
-            print(formatedDate)
-            return formatedDate
-        
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-        
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
-                
-def getActiveUsersCount(tenantId):
-        # make db call to get the total no of active users(EMPLOYEE)   
-        print("no of active users")
-        try:
-            connection = getConnection()
-            cursor = connection.cursor()
-            
-            NO_OF_ACTIVE_USERS = "select count(*) from eg_user u join eg_userrole_v1 ur on u.id = ur.user_id where u.active = 't' and u.type='EMPLOYEE' and ur.role_code = 'EMPLOYEE' and ur.role_tenantid = '"+tenantId+"'" 
-            
-            cursor.execute(NO_OF_ACTIVE_USERS)
-            result = cursor.fetchone()
-            print(result[0])
-            return result[0]
-            
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-            
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
-           
-def getTotalAdvanceCreated(tenantId):
-        # query the postgresql db to get the total count of total advance in the given tenant till date  
-        print("advance sum returned")
-        try:                          
-            connection = getConnection()
-            cursor = connection.cursor()
-             
-            ADVANCE_COUNT_QUERY = "select sum(dd.taxamount) from egbs_demanddetail_v1 dd inner join egbs_demand_v1 d on dd.demandid = d.id where d.status = 'ACTIVE' and dd.taxheadcode='WS_ADVANCE_CARRYFORWARD' and dd.tenantid = '"+tenantId+"'"
-            cursor.execute(ADVANCE_COUNT_QUERY)
-            result = cursor.fetchone()
-            print(result[0])
-            return result[0]
-         
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-        
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
-                
-                
-def getTotalPenaltyCreated(tenantId):
-        # query the postgresql db to get the total count of total penalty in the given tenant till date  
-        print("penalty sum returned")
-        try:                          
-            connection = getConnection()
-            cursor = connection.cursor()
-             
-            PENALTY_COUNT_QUERY = "select sum(dd.taxamount) from egbs_demanddetail_v1 dd inner join egbs_demand_v1 d on dd.demandid = d.id where d.status = 'ACTIVE' and dd.taxheadcode='WS_TIME_PENALTY' and dd.tenantid = '"+tenantId+"'"
-            cursor.execute(PENALTY_COUNT_QUERY)
-            result = cursor.fetchone()
-            print(result[0])
-            return result[0]
-         
-        except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-        
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
+def getMetricSource(sourceName):
+    for source in METRIC_SOURCES:
+        if source.name == sourceName:
+            return source
+    raise ValueError("unknown metric source " + sourceName)
+
+def getMetricsBySource():
+    # registry metrics grouped by source, sources ordered by the priority of their most important metric and
+    # then in the order they are declared
+    metricsBySource = {}
+    for source in METRIC_SOURCES:
+        metricsBySource[source.name] = [metric for metric in METRIC_REGISTRY if metric.source == source.name]
+    sourceNames = sorted((sourceName for sourceName, metrics in metricsBySource.items() if metrics),
+                         key=lambda sourceName: min(metric.priority for metric in metricsBySource[sourceName]))
+    return dict((sourceName, metricsBySource[sourceName]) for sourceName in sourceNames)
+
+def getMetricDefault(metric):
+    # value of a tenant without any row in the source, as the per tenant count(*) / sum / max queries returned it
+    return 0 if metric.aggregate == 'count' else None
+
+def getMetricWatermark(source, metric):
+    # name of the watermark a metric advances with, the first watermark of its source unless the metric names one
+    return metric.watermark or source.watermarks[0][0]
 
+def getMetricsByWatermark(source, metrics):
+    # metrics of a source grouped by watermark name, in the order the watermarks are declared
+    metricsByWatermark = {}
+    for watermarkName, _ in source.watermarks:
+        watermarkMetrics = [metric for metric in metrics if getMetricWatermark(source, metric) == watermarkName]
+        if watermarkMetrics:
+            metricsByWatermark[watermarkName] = watermarkMetrics
+    return metricsByWatermark
 
-def createEntryForRollout(tenant, consumersCreated,countOfRateMaster, lastDemandGenratedDate,collectionsMade,collectionsMadeOnline,lastCollectionDate, expenseBillTillDate, lastExpTrnsDate, noOfBillpaid, noOfDemandRaised, noOfRatings, lastRatingDate, activeUsersCount,totalAdvance,totalPenalty):
-    # create entry into new table in postgres db with the table name roll_outdashboard . enter all field into the db and additional createdtime additional column
+def compileSourceQuery(source, metrics, singleTenant=False, incrementalWatermark=None, tenantList=False, asOfWatermark=None):
+    # one GROUP BY tenant query computing every metric of the source with conditional aggregation.
+    # singleTenant restricts it to %(tenantId)s and tenantList to the %(tenantIds)s of a shard, incrementalWatermark
+    # adds the bounds of that watermark used by processIncremental(). asOfWatermark bounds the rows by %(asOfBound)s
+    # and groups them by the IST day of that watermark's createdtime as well, for backfillDashboard()
+    aggregates = []
+    for metric in metrics:
+        if metric.aggregate not in ('count', 'sum', 'max', 'breakdown'):
+            raise ValueError("unsupported aggregate " + metric.aggregate + " for " + metric.column)
+        if metric.aggregate == 'breakdown' and not source.breakdownColumn:
+            raise ValueError(metric.column + " needs a breakdown column on source " + source.name)
+        aggregate = ('sum' if metric.aggregate == 'breakdown' else metric.aggregate) + "(" + metric.expression + ")"
+        if metric.filter:
+            aggregate += " filter (where " + metric.filter + ")"
+        aggregates.append(aggregate)
     
-    print("inserting data into db")
+    joins = ""
+    conditions = [source.condition] if source.condition else []
+    if incrementalWatermark:
+        timeColumn = dict(source.watermarks)[incrementalWatermark]
+        joins = " left join roll_out_dashboard_watermark w on w.tenantid = " + source.tenantColumn + " and w.sourcetable = %(sourceTable)s"
+        conditions.append(timeColumn + " > coalesce(w.watermark, -1)")
+        conditions.append(timeColumn + " <= %(upperBound)s")
+    if singleTenant:
+        conditions.append(source.tenantColumn + " = %(tenantId)s")
+    if tenantList:
+        conditions.append(source.tenantColumn + " = any(%(tenantIds)s)")
+    
+    groupColumns = [source.tenantColumn]
+    if asOfWatermark:
+        timeColumn = dict(source.watermarks)[asOfWatermark]
+        conditions.append(timeColumn + " <= %(asOfBound)s")
+        groupColumns.append(getDayBucket(timeColumn))
+    if source.breakdownColumn:
+        groupColumns.append(source.breakdownColumn)
+    query = "select " + ", ".join(groupColumns) + ", " + ", ".join(aggregates) + " from " + source.fromClause + joins
+    if conditions:
+        query += " where " + " and ".join(conditions)
+    query += " group by " + ", ".join(groupColumns)
+    if not source.breakdownColumn:
+        return query
+    
+    # fold the per breakdown value groups back into one row per tenant, still a single scan of the source
+    outerAggregates = []
+    for index, metric in enumerate(metrics):
+        value = "m" + str(index)
+        if metric.aggregate == 'breakdown':
+            outerAggregates.append("jsonb_object_agg(coalesce(b, 'UNKNOWN'), " + value + ") filter (where " + value + " is not null)")
+        else:
+            outerAggregates.append(('max' if metric.aggregate == 'max' else 'sum') + "(" + value + ")")
+    keyColumns = "tenantid, day" if asOfWatermark else "tenantid"
+    return "select " + keyColumns + ", " + ", ".join(outerAggregates) + " from (" + query + ") as grouped(" + keyColumns + ", b, " + \
+           ", ".join("m" + str(index) for index in range(len(metrics))) + ") group by " + keyColumns
+
+@instrumented(metricNameArgument=True)
+def runSourceQuery(sourceName, metrics, query, parameters, dayBuckets=False):
+    # run a compiled source query and return a dict of tenantid -> {column: value}, None when the query failed,
+    # timed out or was not started because the run time budget is used up. the results of a dayBuckets query are
+    # keyed by (tenantid, day)
+    if budgetExhausted():
+        print("run time budget used up, skipping", sourceName)
+        return None
+    connection = None
+    role = getReadRole()
     try:
-        connection = getConnection()
+        connection = getConnection(role)
         cursor = connection.cursor()
-        
-        #createdTime = int(round(time.time() * 1000)) // time in currenttimemillis format   
-        
-        tzInfo = pytz.timezone('Asia/Kolkata')
-        createdTime = datetime.now(tz=tzInfo)
-        print("createdtime -->", createdTime)
-        
-        postgres_insert_query = "INSERT INTO roll_out_dashboard (tenantid, projectcode, zone, circle, division, subdivision, section, consumer_created_count, billing_slab_count, last_demand_gen_date, collection_till_date, collection_till_date_online, last_collection_date, expense_count, last_expense_txn_date, paid_status_expense_bill_count, demands_till_date_count, ratings_count, last_rating_date, active_users_count,total_advance,total_penalty, createdtime) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
-        record_to_insert = (tenant['tenantId'], tenant['projectcode'], tenant['zone'], tenant['circle'], tenant['division'], tenant['subdivision'], tenant['section'], consumersCreated,countOfRateMaster, lastDemandGenratedDate,collectionsMade,collectionsMadeOnline,lastCollectionDate, expenseBillTillDate, lastExpTrnsDate, noOfBillpaid, noOfDemandRaised, noOfRatings, lastRatingDate, activeUsersCount,totalAdvance, totalPenalty, createdTime)
-        cursor.execute(postgres_insert_query, record_to_insert)
-       
-        connection.commit()
-        return
-    
-    except (Exception, psycopg2.Error) as error:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-   
+        cursor.execute("set local statement_timeout = %s", (getStatementTimeout(),))
+        cursor.execute(query, parameters)
+        valuesByTenant = {}
+        for result in cursor.fetchall():
+            values = {}
+            keyLength = 2 if dayBuckets else 1
+            for metric, value in zip(metrics, result[keyLength:]):
+                if metric.aggregate == 'max' and value is not None:
+                    value = datetime.fromtimestamp(value/1000.0)
+                values[metric.column] = value
+            valuesByTenant[tuple(result[:2]) if dayBuckets else result[0]] = values
+        return valuesByTenant
+
+    except Exception as exception:
+        logException(exception)
+        return None
+
     finally:
-            if connection:
-                cursor.close()
-                connection.close() 
+        if connection:
+            cursor.close()
+            releaseConnection(connection, role)
 
-def process():
-    print("continue is the process")
-       
+# last activity dates are read per tenant with max(createdtime), which a (tenantid, createdtime) index answers with one
+# backward index probe per tenant instead of sorting or scanning the tenant's rows. conditions use unqualified columns
+# of the table
+LastActivity = namedtuple('LastActivity', ['column', 'table', 'condition'])
+
+LAST_ACTIVITY_METRICS = [
+    LastActivity('last_demand_gen_date', 'egbs_demand_v1', None),
+    LastActivity('last_collection_date', 'egcl_paymentdetail', "businessservice = 'WS'"),
+    LastActivity('last_expense_txn_date', 'eg_echallan', None),
+    LastActivity('last_rating_date', 'eg_ws_feedback', None)
+]
+
+# tables with a valid (tenantid, createdtime) index, filled by checkActivityIndexes() at the start of a run
+activityIndexedTables = set()
+
+def getActivityIndexName(table):
+    return "idx_" + table + "_tenantid_createdtime"
+
+def getActivityCondition(table):
+    return next(metric.condition for metric in LAST_ACTIVITY_METRICS if metric.table == table)
+
+def getPredicateKey(predicate):
+    # pg_get_expr() adds casts and parentheses to an index predicate, both are dropped to compare it with a condition
+    return re.sub(r"[()\s]", "", re.sub(r"::[a-z_ ]+", "", predicate)) if predicate else None
+
+@instrumented
+def checkActivityIndexes(provision=True):
+    # report the last activity tables without a (tenantid, createdtime) index and, with PROVISION_INDEXES=true, create
+    # them with CREATE INDEX CONCURRENTLY so the source tables stay writable meanwhile. the index of a metric with a
+    # condition is partial on that condition, so its probes are index only scans as well; a plain index still serves
+    # the probes but is reported as missing. tables left without a usable index are read with one GROUP BY scan
+    # instead of the per tenant index probes
+    tables = sorted(set(metric.table for metric in LAST_ACTIVITY_METRICS))
+    activityIndexedTables.clear()
+    connection = None
     try:
         connection = getConnection()
         cursor = connection.cursor()
+        indexQuery = """select c.relname, pg_get_expr(i.indpred, i.indrelid) from pg_index i
+            join pg_class c on c.oid = i.indrelid
+            join pg_attribute a0 on a0.attrelid = c.oid and a0.attnum = i.indkey[0]
+            join pg_attribute a1 on a1.attrelid = c.oid and a1.attnum = i.indkey[1]
+            where c.relname = any(%s) and pg_table_is_visible(c.oid) and i.indisvalid
+            and a0.attname = 'tenantid' and a1.attname = 'createdtime'"""
+        cursor.execute(indexQuery, (tables,))
+        coveredTables = set()
+        for table, predicate in cursor.fetchall():
+            conditionKey = getPredicateKey(getActivityCondition(table))
+            if getPredicateKey(predicate) == conditionKey:
+                coveredTables.add(table)
+                activityIndexedTables.add(table)
+            elif predicate is None:
+                activityIndexedTables.add(table)
+        missingTables = [table for table in tables if table not in coveredTables]
+        runSummary['missingIndexes'] = [getActivityIndexName(table) for table in missingTables]
+        for table in missingTables:
+            print("missing index", getActivityIndexName(table), "on", table, "(tenantid, createdtime)")
         
-        print("cursor: ",cursor)
-       
-        DROPPING_TABLE_QUERY = " drop table if exists roll_out_dashboard "
-        cursor.execute(DROPPING_TABLE_QUERY)
-        
-        connection.commit()
-        
-        createTableQuery = createTable()
-        cursor.execute(createTableQuery)
-        
-        connection.commit()
-        
-        print("table dropped")
+        if missingTables and provision and os.getenv('PROVISION_INDEXES', 'false').lower() == 'true':
+            # concurrent index builds cannot run inside a transaction block
+            connection.rollback()
+            connection.autocommit = True
+            for table in missingTables:
+                indexName = getActivityIndexName(table)
+                try:
+                    # a concurrent build that failed earlier leaves an invalid index behind under the same name
+                    cursor.execute("drop index concurrently if exists " + indexName)
+                    print("creating index", indexName)
+                    condition = getActivityCondition(table)
+                    cursor.execute("create index concurrently " + indexName + " on " + table + " (tenantid, createdtime)" +
+                                   (" where " + condition if condition else ""))
+                    activityIndexedTables.add(table)
+                    runSummary['missingIndexes'].remove(indexName)
+                except Exception as exception:
+                    logException(exception, "index could not be created", indexName)
+        return sorted(activityIndexedTables)
+    
     except Exception as exception:
-            print("Exception occurred while connecting to the database")
-            print(exception)
-            
+        logException(exception)
+        return None
+    
     finally:
         if connection:
+            connection.rollback()
+            connection.autocommit = False
             cursor.close()
-            connection.close()
-    
-    tenants = getGPWSCHeirarchy()
-    for tenant in tenants:
-        print(tenant)
-        consumersCreated = getConsumerCreated(tenant['tenantId'])
-        countOfRateMaster = getRateMasters(tenant['tenantId'])
-        lastDemandGenratedDate = getLastDemandDate(tenant['tenantId'])
-        collectionsMade = getCollectionsMade(tenant['tenantId'])
-        collectionsMadeOnline = getCollectionsMadeOnline(tenant['tenantId'])
-        lastCollectionDate = getLastCollectionDate(tenant['tenantId'])
-        expenseBillTillDate = getExpenseBillEntered(tenant['tenantId'])
-        lastExpTrnsDate = getLastExpTransactionDate(tenant['tenantId'])
-        noOfBillpaid= getNoOfBillsPaid(tenant['tenantId'])
-        noOfDemandRaised= getTotalDemandRaised(tenant['tenantId'])
-        noOfRatings = getRatingCount(tenant['tenantId'])
-        lastRatingDate= getLastRatingDate(tenant['tenantId'])
-        activeUsersCount= getActiveUsersCount(tenant['tenantId'])
-        totalAdvance= getTotalAdvanceCreated(tenant['tenantId'])
-        totalPenalty= getTotalPenaltyCreated(tenant['tenantId'])
-        createEntryForRollout(tenant, consumersCreated,countOfRateMaster, lastDemandGenratedDate,collectionsMade,collectionsMadeOnline,lastCollectionDate, expenseBillTillDate, lastExpTrnsDate, noOfBillpaid, noOfDemandRaised, noOfRatings, lastRatingDate, activeUsersCount,totalAdvance, totalPenalty)
-    print("End of rollout dashboard")
-    return 
+            releaseConnection(connection)
 
-        
-def getConnection():
-    
-    dbHost = os.getenv('DB_HOST')
-    dbSchema =  os.getenv('DB_SCHEMA')
-    dbUser =  os.getenv('DB_USER')
-    dbPassword =  os.getenv('DB_PWD')
-    dbPort =  os.getenv('DB_PORT')
+def compileLastActivityQuery():
+    # one query over the %(tenantIds)s list, indexed tables are probed per tenant with a correlated max() and the
+    # others are aggregated once with GROUP BY tenantid
+    selects = []
+    joins = []
+    for index, metric in enumerate(LAST_ACTIVITY_METRICS):
+        condition = " and " + metric.condition if metric.condition else ""
+        if metric.table in activityIndexedTables:
+            selects.append("(select max(a.createdtime) from " + metric.table + " a where a.tenantid = t.tenantid" + condition + ")")
+        else:
+            alias = "g" + str(index)
+            joins.append(" left join (select tenantid, max(createdtime) as createdtime from " + metric.table +
+                         " where tenantid = any(%(tenantIds)s)" + condition + " group by tenantid) " + alias + " on " + alias + ".tenantid = t.tenantid")
+            selects.append(alias + ".createdtime")
+    return "select t.tenantid, " + ", ".join(selects) + " from unnest(%(tenantIds)s::varchar[]) as t(tenantid)" + "".join(joins)
+
+@instrumented
+def runLastActivityQuery(tenantIds):
+    # latest createdtime of every LAST_ACTIVITY_METRICS table as a dict of tenantid -> {column: date}, None on failure
+    if budgetExhausted():
+        print("run time budget used up, skipping last activity dates")
+        return None
+    connection = None
+    role = getReadRole()
+    try:
+        connection = getConnection(role)
+        cursor = connection.cursor()
+        cursor.execute("set local statement_timeout = %s", (getStatementTimeout(),))
+        cursor.execute(compileLastActivityQuery(), {"tenantIds": list(tenantIds)})
+        lastActivity = {}
+        for result in cursor.fetchall():
+            lastActivity[result[0]] = dict((metric.column, datetime.fromtimestamp(value/1000.0).date() if value is not None else None)
+                                           for metric, value in zip(LAST_ACTIVITY_METRICS, result[1:]))
+        return lastActivity
     
-    connection = psycopg2.connect(user=dbUser,
-                            password=dbPassword,
-                            host=dbHost,
-                            port=dbPort,
-                            database=dbSchema)
-   
-    return connection
+    except Exception as exception:
+        logException(exception)
+        return None
     
-def getCurrentDate():
-    currentDate = datetime.today().strftime('%Y-%m-%d')
-    currentDateInMillis = str(parser.parse(currentDate).timestamp() * 1000)
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection, role)
+
+def buildTenantMetrics(sourceResults, lastActivity, tenantId):
+    # pick the tenant's values out of the per source results, tenants without rows get the metric default.
+    # columns of a failed or skipped query are listed in stale_columns and filled by buildRolloutRecords()
+    metrics = {}
+    staleColumns = []
+    for metric in METRIC_REGISTRY:
+        valuesByTenant = sourceResults.get(metric.source)
+        if valuesByTenant is None:
+            staleColumns.append(metric.column)
+            continue
+        metrics[metric.column] = valuesByTenant.get(tenantId, {}).get(metric.column, getMetricDefault(metric))
+    for metric in LAST_ACTIVITY_METRICS:
+        if lastActivity is None:
+            staleColumns.append(metric.column)
+            continue
+        metrics[metric.column] = lastActivity.get(tenantId, {}).get(metric.column)
+    metrics['billing_slab_count'] = getRateMasters(tenantId)
+    if metrics['billing_slab_count'] is None:
+        staleColumns.append('billing_slab_count')
+    metrics['stale_columns'] = staleColumns
+    return metrics
+
+def getStaleMetrics():
+    # metrics of a tenant that could not be collected at all, every cell is carried forward
+    return {'stale_columns': [column for column in ROLLOUT_METRIC_COLUMNS if column != 'stale_columns']}
+
+@instrumented
+def loadPreviousValues(tenantIds):
+    # last published values of the tenants, from the live roll_out_dashboard like the incremental mode or, for tenants
+    # without a live row, from their latest roll_out_dashboard_snapshot row, as a dict of tenantid -> {column: value}
+    columns = ROLLOUT_HEIRARCHY_COLUMNS + ROLLOUT_METRIC_COLUMNS
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        cursor.execute("select to_regclass('roll_out_dashboard_snapshot') is not null, to_regclass('roll_out_dashboard') is not null")
+        snapshotExists, liveExists = cursor.fetchone()
+        previousQueries = []
+        if snapshotExists:
+            previousQueries.append("select 1 as preference, snapshot_date, " + ", ".join(columns) + " from roll_out_dashboard_snapshot where tenantid = any(%(tenantIds)s)")
+        if liveExists:
+            previousQueries.append("select 0 as preference, null::date, " + ", ".join(columns) + " from roll_out_dashboard where tenantid = any(%(tenantIds)s)")
+        if not previousQueries:
+            return {}
+        cursor.execute("select distinct on (tenantid) " + ", ".join(columns) + " from (" + " union all ".join(previousQueries) +
+                       ") as previous order by tenantid, preference, snapshot_date desc", {"tenantIds": list(tenantIds)})
+        return dict((row[0], dict(zip(columns, row))) for row in cursor.fetchall())
     
-    return currentDateInMillis
-     
+    except Exception as exception:
+        logException(exception, "previous values could not be read, stale cells are left empty")
+        return {}
     
-def createTable():
+    finally:
+        if connection:
+            connection.rollback()
+            cursor.close()
+            releaseConnection(connection)
+
+def buildRolloutRecords(tenantMetricsList):
+    # fill the stale cells of a batch of (tenant, metrics) from the published dashboard and build the rows to write,
+    # stale_columns keeps the comma separated names of the carried forward cells
+    staleTenantIds = [tenant.tenantId for tenant, metrics in tenantMetricsList if metrics['stale_columns']]
+    previousValues = loadPreviousValues(staleTenantIds) if staleTenantIds else {}
+    records = []
+    for tenant, metrics in tenantMetricsList:
+        staleColumns = metrics['stale_columns']
+        previousRow = previousValues.get(tenant.tenantId, {})
+        for column in staleColumns:
+            metrics[column] = previousRow.get(column)
+        metrics['stale_columns'] = ",".join(staleColumns) or None
+        records.append(createEntryForRollout(tenant, metrics))
+    staleCellCount = sum(len(metrics['stale_columns'].split(",")) for _, metrics in tenantMetricsList if metrics['stale_columns'])
+    runSummary['staleCells'] = runSummary.get('staleCells', 0) + staleCellCount
+    if staleCellCount:
+        print(staleCellCount, "stale cells of", len(staleTenantIds), "tenants carried forward")
+    return records
+
+
+def processAllTenants(tenants, restrictTenants=False):
+    # set based variant of the per tenant loop in process(), every source is scanned once for all the tenants
+    # with GROUP BY tenantid and the results are joined to the heirarchy list in memory as (tenant, metrics) pairs.
+    # restrictTenants limits the scans to the given tenants, used by the shards
+    sourceResults = {}
+    parameters = {"tenantIds": [tenant.tenantId for tenant in tenants]} if restrictTenants else {}
+    for sourceName, metrics in getMetricsBySource().items():
+        print("computing metrics of", sourceName, "for all tenants")
+        query = compileSourceQuery(getMetricSource(sourceName), metrics, tenantList=restrictTenants)
+        sourceResults[sourceName] = runSourceQuery(sourceName, metrics, query, parameters)
+    print("reading last activity dates of all tenants")
+    lastActivity = runLastActivityQuery([tenant.tenantId for tenant in tenants])
     
-    CREATE_TABLE_QUERY = """create table roll_out_dashboard(
-        id SERIAL primary key, 	
-        tenantid varchar(250) NOT NULL,
-        projectcode varchar(66),
-        zone varchar(250),
+    return [(tenant, buildTenantMetrics(sourceResults, lastActivity, tenant.tenantId)) for tenant in tenants]
+
+ROLLOUT_STAGING_TABLE = 'roll_out_dashboard_staging'
+
+def removeDuplicateTenants(tenants):
+    # the same village can appear under more than one project in the heirarchy, roll_out_dashboard keeps one row per tenantid
+    uniqueTenants = []
+    seenTenantIds = set()
+    for tenant in tenants:
+        if tenant.tenantId in seenTenantIds:
+            print("duplicate tenant in heirarchy skipped", tenant)
+            continue
+        seenTenantIds.add(tenant.tenantId)
+        uniqueTenants.append(tenant)
+    return uniqueTenants
+
+def getHeirarchyTenants():
+    # the unique villages of the heirarchy, None when neither mdms nor the cache returned any. every mode stops there
+    # and reports a failed run instead of publishing or backfilling a dashboard without villages
+    tenants = getGPWSCHeirarchy()
+    if not tenants:
+        print("no heirarchy villages from mdms or the cache, the run is stopped")
+        return None
+    return removeDuplicateTenants(tenants)
+
+def getRolloutIndexQueries(tableName):
+    # indexes of the dashboard table, built on the staging table only after the bulk load
+    return [
+        "create unique index if not exists " + tableName + "_tenantid_idx on " + tableName + " (tenantid)",
+        "create index if not exists " + tableName + "_heirarchy_idx on " + tableName + " (zone, circle, division, subdivision, section)"
+    ]
+
+def getDeduplicateQuery(tableName):
+    # tables filled by an older version before the unique tenantid index may hold several rows of a tenant, only the
+    # newest one is kept so the index can be built. run only while the index is missing
+    return """delete from """ + tableName + """ where id in (select id from (
+        select id, row_number() over (partition by tenantid order by createdtime desc nulls last, id desc) as position
+        from """ + tableName + """) ranked where position > 1)"""
+
+ROLLOUT_ROLLUP_STAGING_TABLE = 'roll_out_dashboard_rollup_staging'
+ROLLOUT_DATE_COLUMNS = [metric.column for metric in LAST_ACTIVITY_METRICS]
+# JSONB breakdowns have no sum, the rollup leaves them out together with the stale cell markers
+ROLLOUT_BREAKDOWN_COLUMNS = ['collection_by_payment_mode']
+ROLLOUT_ROLLUP_EXCLUDED_COLUMNS = ROLLOUT_BREAKDOWN_COLUMNS + ['stale_columns']
+# breakdowns are kept as dicts in the metric rows and written as JSONB
+extensions.register_adapter(dict, extras.Json)
+
+# the writers of roll_out_dashboard_rollup (full rebuild swap, incremental and stream publishes) take this lock in the
+# transaction that replaces it
+ROLLUP_LOCK_QUERY = "select pg_advisory_xact_lock(hashtext('roll_out_dashboard_rollup'))"
+
+def getRollupStagingTable(stagingTable):
+    # the rollup of a full rebuild is built next to the staging table of its run and committed before the swap, a
+    # shared name would be dropped by an incremental or stream publish in between
+    return stagingTable + "_rollup"
+
+def buildRollupTable(cursor, sourceTable, rollupTable=ROLLOUT_ROLLUP_STAGING_TABLE):
+    # precompute the dashboard aggregates of every heirarchy level (state, zone, circle, division, subdivision, section)
+    # from the tenant rows in one ROLLUP pass into the rollup staging table, counts and amounts are summed and the
+    # last activity dates take the latest tenant date. columns below the row's level are null
+    aggregates = []
+    for column in ROLLOUT_METRIC_COLUMNS:
+        if column in ROLLOUT_ROLLUP_EXCLUDED_COLUMNS:
+            continue
+        aggregate = "max" if column in ROLLOUT_DATE_COLUMNS else "sum"
+        aggregates.append(aggregate + "(" + column + ") as " + column)
+    
+    cursor.execute("drop table if exists " + rollupTable)
+    cursor.execute("""create table """ + rollupTable + """ as
+        select case when grouping(zone) = 1 then 'state'
+                    when grouping(circle) = 1 then 'zone'
+                    when grouping(division) = 1 then 'circle'
+                    when grouping(subdivision) = 1 then 'division'
+                    when grouping(section) = 1 then 'subdivision'
+                    else 'section' end as level,
+               zone, circle, division, subdivision, section,
+               count(*) as tenant_count,
+               count(stale_columns) as stale_tenant_count,
+               """ + ",\n               ".join(aggregates) + """,
+               max(createdtime) as createdtime
+        from """ + sourceTable + """
+        group by rollup (zone, circle, division, subdivision, section)""")
+    cursor.execute("create index " + rollupTable + "_level_idx on " + rollupTable + " (level, zone, circle, division, subdivision, section)")
+
+def swapRollupTable(cursor, rollupTable=ROLLOUT_ROLLUP_STAGING_TABLE):
+    cursor.execute("drop table if exists roll_out_dashboard_rollup")
+    cursor.execute("alter table " + rollupTable + " rename to roll_out_dashboard_rollup")
+    cursor.execute("alter index " + rollupTable + "_level_idx rename to roll_out_dashboard_rollup_level_idx")
+
+@instrumented
+def publishRollupTable():
+    # rebuild roll_out_dashboard_rollup from the live table, used after an incremental refresh
+    print("publishing heirarchy rollup")
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        
+        cursor.execute(ROLLUP_LOCK_QUERY)
+        buildRollupTable(cursor, 'roll_out_dashboard')
+        cursor.execute("set local lock_timeout = %s", (os.getenv('SWAP_LOCK_TIMEOUT', '5s'),))
+        swapRollupTable(cursor)
+        connection.commit()
+        return True
+    
+    except Exception as exception:
+        logException(exception)
+        return False
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+
+@instrumented
+def publishStagingTable(stagingTable=None, runId=None):
+    # index the loaded staging table, build its heirarchy rollup and swap both in place of roll_out_dashboard and
+    # roll_out_dashboard_rollup inside one transaction, so dashboard queries either see the previous complete tables
+    # or the new ones and never a partially filled one. the checkpoints of the run go in the same transaction, a
+    # resumed run never finds checkpoints of a staging table that was already published.
+    # lock_timeout keeps the swap from queueing behind a long running dashboard query, it is retried instead
+    stagingTable = stagingTable or ROLLOUT_STAGING_TABLE
+    print("publishing staging table", stagingTable)
+    lockTimeout = os.getenv('SWAP_LOCK_TIMEOUT', '5s')
+    swapAttempts = int(os.getenv('SWAP_ATTEMPTS', '5'))
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        
+        for indexQuery in getRolloutIndexQueries(stagingTable):
+            cursor.execute(indexQuery)
+        cursor.execute("analyze " + stagingTable)
+        rollupTable = getRollupStagingTable(stagingTable)
+        buildRollupTable(cursor, stagingTable, rollupTable)
+        connection.commit()
+        
+        for attempt in range(1, swapAttempts + 1):
+            try:
+                cursor.execute("set local lock_timeout = %s", (lockTimeout,))
+                cursor.execute(ROLLUP_LOCK_QUERY)
+                cursor.execute("drop table if exists roll_out_dashboard")
+                cursor.execute("alter table " + stagingTable + " rename to roll_out_dashboard")
+                cursor.execute("alter table roll_out_dashboard rename constraint " + stagingTable + "_pkey to roll_out_dashboard_pkey")
+                cursor.execute("alter sequence " + stagingTable + "_id_seq rename to roll_out_dashboard_id_seq")
+                cursor.execute("alter index " + stagingTable + "_tenantid_idx rename to roll_out_dashboard_tenantid_idx")
+                cursor.execute("alter index " + stagingTable + "_heirarchy_idx rename to roll_out_dashboard_heirarchy_idx")
+                swapRollupTable(cursor, rollupTable)
+                # the rebuilt totals already hold the rows behind the incremental watermarks, the next incremental
+                # run must read every tenant from the beginning instead of adding them again
+                cursor.execute(CREATE_WATERMARK_TABLE_QUERY)
+                cursor.execute("delete from roll_out_dashboard_watermark")
+                if runId:
+                    cursor.execute(CREATE_CHECKPOINT_TABLE_QUERY)
+                    cursor.execute("delete from roll_out_dashboard_checkpoint where run_id = %s", (runId,))
+                connection.commit()
+                print("table swapped")
+                return True
+            except errors.LockNotAvailable:
+                connection.rollback()
+                print("lock timeout while swapping table, attempt", attempt)
+                time.sleep(attempt)
+        print("staging table could not be swapped in, roll_out_dashboard keeps the previous data")
+        return False
+    
+    except Exception as exception:
+        logException(exception)
+        return False
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+
+def getSnapshotPartitionName(monthStart):
+    return "roll_out_dashboard_snapshot_y%04dm%02d" % (monthStart.year, monthStart.month)
+
+@instrumented
+def writeSnapshot():
+    # append the published roll_out_dashboard to the monthly partitioned roll_out_dashboard_snapshot table keyed by
+    # (tenantid, snapshot_date), a second run on the same day replaces that day's rows. partitions older than
+    # SNAPSHOT_RETENTION_MONTHS are dropped so trend queries in metabase read a small pre aggregated table
+    if os.getenv('SNAPSHOT_ENABLED', 'true').lower() != 'true':
+        return
+    print("writing dashboard snapshot")
+    retentionMonths = int(os.getenv('SNAPSHOT_RETENTION_MONTHS', '24'))
+    tzInfo = pytz.timezone('Asia/Kolkata')
+    snapshotDate = datetime.now(tz=tzInfo).date()
+    monthStart = snapshotDate.replace(day=1)
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        
+        cursor.execute(createSnapshotTable())
+        for columnQuery in getAddColumnQueries('roll_out_dashboard_snapshot'):
+            cursor.execute(columnQuery)
+        createSnapshotPartitions(cursor, snapshotDate, snapshotDate)
+        
+        snapshotColumns = ROLLOUT_HEIRARCHY_COLUMNS + ROLLOUT_METRIC_COLUMNS + ['createdtime']
+        cursor.execute("INSERT INTO roll_out_dashboard_snapshot (snapshot_date, " + ", ".join(snapshotColumns) + ") select %s, " + ", ".join(snapshotColumns) +
+                       " from roll_out_dashboard ON CONFLICT (tenantid, snapshot_date) DO UPDATE SET " + ", ".join(column + " = excluded." + column for column in snapshotColumns[1:]),
+                       (snapshotDate,))
+        print(cursor.rowcount, "snapshot rows written for", snapshotDate)
+        
+        # the partition covering the first retained month is kept, every partition before it is dropped
+        oldestPartition = getSnapshotPartitionName(monthStart - relativedelta(months=retentionMonths))
+        cursor.execute("""select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid join pg_class p on p.oid = i.inhparent
+            where p.relname = 'roll_out_dashboard_snapshot'""")
+        for (partitionName,) in cursor.fetchall():
+            if partitionName < oldestPartition:
+                print("dropping snapshot partition", partitionName)
+                cursor.execute("drop table " + partitionName)
+        
+        connection.commit()
+    
+    except Exception as exception:
+        logException(exception)
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+
+ROLLOUT_HEIRARCHY_COLUMNS = ['tenantid', 'projectcode', 'zone', 'circle', 'division', 'subdivision', 'section']
+ROLLOUT_METRIC_COLUMNS = ['consumer_created_count', 'billing_slab_count', 'last_demand_gen_date', 'collection_till_date', 'collection_till_date_online',
+                          'last_collection_date', 'expense_count', 'last_expense_txn_date', 'paid_status_expense_bill_count', 'demands_till_date_count',
+                          'ratings_count', 'last_rating_date', 'active_users_count', 'total_advance', 'total_penalty', 'collection_by_payment_mode',
+                          'stale_columns']
+
+CREATE_WATERMARK_TABLE_QUERY = """create table if not exists roll_out_dashboard_watermark(
+        tenantid varchar(250) NOT NULL,
+        sourcetable varchar(64) NOT NULL,
+        watermark BIGINT NOT NULL,
+        lastmodifiedtime TIMESTAMP NOT NULL,
+        primary key (tenantid, sourcetable)
+        )"""
+
+# watermarks only move forward, a stream flush can leave one past the upper bound of the next incremental run and
+# moving it back would count the rows in between a second time
+WATERMARK_UPSERT_QUERY = """INSERT INTO roll_out_dashboard_watermark (tenantid, sourcetable, watermark, lastmodifiedtime) VALUES %s
+    ON CONFLICT (tenantid, sourcetable) DO UPDATE SET watermark = greatest(roll_out_dashboard_watermark.watermark, excluded.watermark),
+    lastmodifiedtime = excluded.lastmodifiedtime"""
+
+def mergeIncrementalValue(aggregate, storedValue, newValue):
+    # fold the value computed over the new rows into the stored running value, counts and sums are added
+    # and max keeps the latest date, breakdowns are added per key
+    if aggregate == 'breakdown':
+        if storedValue is None or newValue is None:
+            return newValue if storedValue is None else storedValue
+        merged = dict(storedValue)
+        for key, value in newValue.items():
+            merged[key] = round(merged.get(key, 0) + value, 2)
+        return merged
+    
+    if aggregate == 'max':
+        if newValue is not None:
+            newValue = newValue.date()
+        if storedValue is None or newValue is None:
+            return newValue if storedValue is None else storedValue
+        return max(storedValue, newValue)
+    
+    if storedValue is None and newValue is None:
+        return 0 if aggregate == 'count' else None
+    return (storedValue or 0) + (newValue or 0)
+
+def replicaHasWatermarks(primaryWatermarkTime):
+    connection = None
+    try:
+        connection = getConnection('read')
+        cursor = connection.cursor()
+        cursor.execute("select max(lastmodifiedtime) from roll_out_dashboard_watermark")
+        return cursor.fetchone()[0] == primaryWatermarkTime
+    
+    except Exception as exception:
+        logException(exception, "watermarks could not be read from the read replica")
+        return False
+    
+    finally:
+        if connection:
+            connection.rollback()
+            cursor.close()
+            releaseConnection(connection, 'read')
+
+@instrumented
+def processIncremental(tenants):
+    # incremental refresh of roll_out_dashboard. every source table is scanned only for rows created after the
+    # per tenant watermark, the result is added to the stored running totals / last dates and only the tenants
+    # whose row changed are upserted. watermarks trail the clock by INCREMENTAL_LAG_MINUTES so rows committed
+    # late with an older createdtime are still picked up by the next run.
+    # status changes on already counted rows (connection deactivated, challan paid later) are not seen here,
+    # a periodic full run (ROLLOUT_MODE=bulk) resets any drift
+    print("incremental refresh of rollout dashboard")
+    lagMinutes = int(os.getenv('INCREMENTAL_LAG_MINUTES', '10'))
+    # rows the read replica has not replayed yet must stay above the new watermark
+    visibleTime = readReplicaState['visibleTime'] if readReplicaState['active'] else time.time()
+    upperBound = int((min(time.time(), visibleTime) - lagMinutes * 60) * 1000)
+    
+    uniqueTenants = {}
+    for tenant in tenants:
+        uniqueTenants.setdefault(tenant.tenantId, tenant)
+    
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        
+        cursor.execute(createTable())
+        cursor.execute("select column_name from information_schema.columns where table_schema = current_schema() and table_name = 'roll_out_dashboard'")
+        existingColumns = set(row[0] for row in cursor.fetchall())
+        for columnQuery in getAddColumnQueries('roll_out_dashboard'):
+            cursor.execute(columnQuery)
+        cursor.execute("select to_regclass('roll_out_dashboard_tenantid_idx') is null")
+        if cursor.fetchone()[0]:
+            cursor.execute(getDeduplicateQuery('roll_out_dashboard'))
+            if cursor.rowcount:
+                print("removed", cursor.rowcount, "older duplicate tenant rows from roll_out_dashboard")
+        for indexQuery in getRolloutIndexQueries('roll_out_dashboard'):
+            cursor.execute(indexQuery)
+        cursor.execute(CREATE_WATERMARK_TABLE_QUERY)
+        # a metric column added by this version has no stored totals, its watermarks are reset so the
+        # metric is read from the beginning instead of counting only the new rows
+        resetWatermarks = set(getMetricWatermark(getMetricSource(metric.source), metric) for metric in METRIC_REGISTRY
+                              if metric.column not in existingColumns and getMetricSource(metric.source).watermarks)
+        if resetWatermarks:
+            print("resetting watermarks of new metric columns", sorted(resetWatermarks))
+            cursor.execute("delete from roll_out_dashboard_watermark where sourcetable = any(%s)", (sorted(resetWatermarks),))
+        connection.commit()
+        
+        cursor.execute("select " + ", ".join(ROLLOUT_HEIRARCHY_COLUMNS + ROLLOUT_METRIC_COLUMNS) + " from roll_out_dashboard")
+        storedRows = {}
+        for row in cursor.fetchall():
+            storedRows[row[0]] = dict(zip(ROLLOUT_HEIRARCHY_COLUMNS + ROLLOUT_METRIC_COLUMNS, row))
+        
+        cursor.execute("select tenantid, sourcetable from roll_out_dashboard_watermark")
+        watermarks = set(cursor.fetchall())
+        # the source queries join the watermarks on the replica, a replica that has not replayed the last ones
+        # would count rows a second time
+        if readReplicaState['active']:
+            cursor.execute("select max(lastmodifiedtime) from roll_out_dashboard_watermark")
+            if not replicaHasWatermarks(cursor.fetchone()[0]):
+                print("read replica has not replayed the last watermarks, metric queries read from the primary")
+                readReplicaState['active'] = False
+                runSummary['readFrom'] = 'primary'
+        connection.commit()
+        # the scans borrow read connections, which come from this same pool without a read replica. the connection is
+        # given back meanwhile so a pool of DB_POOL_MAX_SIZE=1 does not wait on itself
+        cursor.close()
+        releaseConnection(connection)
+        connection = None
+        
+        newRows = {}
+        staleColumns = {}
+        for tenantId in uniqueTenants:
+            newRows[tenantId] = {}
+            staleColumns[tenantId] = []
+        
+        def keepStoredValues(columns):
+            # a failed or skipped query leaves the stored values of its columns in place and marks them stale
+            for tenantId, row in newRows.items():
+                storedRow = storedRows.get(tenantId) or {}
+                for column in columns:
+                    row[column] = storedRow.get(column)
+                staleColumns[tenantId].extend(columns)
+        
+        watermarkSources = []
+        for sourceName, metrics in getMetricsBySource().items():
+            source = getMetricSource(sourceName)
+            print("scanning new rows of", sourceName)
+            if not source.watermarks:
+                # sources without a createdtime are recomputed in full and replace the stored values
+                results = runSourceQuery(sourceName, metrics, compileSourceQuery(source, metrics), {})
+                if results is None:
+                    keepStoredValues([metric.column for metric in metrics])
+                    continue
+                for tenantId, row in newRows.items():
+                    for metric in metrics:
+                        row[metric.column] = results.get(tenantId, {}).get(metric.column, getMetricDefault(metric))
+                continue
+            
+            # metrics of a source that advance with different createdtime columns need one window scan per watermark
+            for watermarkName, watermarkMetrics in getMetricsByWatermark(source, metrics).items():
+                deltas = runSourceQuery(sourceName, watermarkMetrics, compileSourceQuery(source, watermarkMetrics, incrementalWatermark=watermarkName),
+                                        {"sourceTable": watermarkName, "upperBound": upperBound})
+                # a failed scan must not advance the watermarks over rows it never counted, the next run reads them
+                if deltas is None:
+                    keepStoredValues([metric.column for metric in watermarkMetrics])
+                    continue
+                watermarkSources.append(watermarkName)
+                print(len(deltas), "tenants with new rows in", watermarkName)
+                
+                for tenantId, row in newRows.items():
+                    # a tenant seen for the first time is read from the beginning, so its stored values must not be added again
+                    storedRow = storedRows.get(tenantId) if (tenantId, watermarkName) in watermarks else None
+                    delta = deltas.get(tenantId, {})
+                    for metric in watermarkMetrics:
+                        storedValue = storedRow[metric.column] if storedRow else None
+                        row[metric.column] = mergeIncrementalValue(metric.aggregate, storedValue, delta.get(metric.column))
+        
+        # last activity dates are read again in full, the index probes cost about as much as a watermark window
+        lastActivity = runLastActivityQuery(uniqueTenants.keys())
+        if lastActivity is None:
+            keepStoredValues(ROLLOUT_DATE_COLUMNS)
+        else:
+            for tenantId, row in newRows.items():
+                for metric in LAST_ACTIVITY_METRICS:
+                    row[metric.column] = lastActivity.get(tenantId, {}).get(metric.column)
+        
+        # billing slabs come from mdms and are served from the per run cache
+        changedRecords = []
+        for tenantId, row in newRows.items():
+            row['billing_slab_count'] = getRateMasters(tenantId)
+            if row['billing_slab_count'] is None:
+                row['billing_slab_count'] = (storedRows.get(tenantId) or {}).get('billing_slab_count')
+                staleColumns[tenantId].append('billing_slab_count')
+            row['stale_columns'] = ",".join(staleColumns[tenantId]) or None
+            runSummary['staleCells'] = runSummary.get('staleCells', 0) + len(staleColumns[tenantId])
+            record = createEntryForRollout(uniqueTenants[tenantId], row)
+            storedRow = storedRows.get(tenantId)
+            if storedRow is None or [storedRow[column] for column in ROLLOUT_HEIRARCHY_COLUMNS + ROLLOUT_METRIC_COLUMNS] != record:
+                changedRecords.append(record)
+        
+        connection = getConnection()
+        cursor = connection.cursor()
+        tzInfo = pytz.timezone('Asia/Kolkata')
+        createdTime = datetime.now(tz=tzInfo)
+        insertColumns = ROLLOUT_HEIRARCHY_COLUMNS + ROLLOUT_METRIC_COLUMNS + ['createdtime']
+        upsertQuery = "INSERT INTO roll_out_dashboard (" + ", ".join(insertColumns) + ") VALUES %s ON CONFLICT (tenantid) DO UPDATE SET " + \
+                      ", ".join(column + " = excluded." + column for column in insertColumns[1:])
+        pageSize = int(os.getenv('INSERT_PAGE_SIZE', '1000'))
+        extras.execute_values(cursor, upsertQuery, [record + [createdTime] for record in changedRecords], page_size=pageSize)
+        
+        watermarkRecords = [(tenantId, sourceName, upperBound, createdTime) for tenantId in uniqueTenants for sourceName in watermarkSources]
+        extras.execute_values(cursor, WATERMARK_UPSERT_QUERY, watermarkRecords, page_size=pageSize)
+        
+        connection.commit()
+        print(len(changedRecords), "tenants upserted")
+        return True
+        
+    except Exception as exception:
+        logException(exception)
+        return False
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+
+def collectTenantMetrics(tenant):
+    # run every registry source for one tenant, called from the worker pool in process().
+    # a failure is kept to the tenant it happened in so the rest of the run carries on
+    print(tenant)
+    with recordTenant(tenant.tenantId):
+        return collectMetricsOfTenant(tenant)
+
+def collectMetricsOfTenant(tenant):
+    # a tenant that fails or comes after the run time budget is used up keeps its previous values
+    if budgetExhausted():
+        return getStaleMetrics()
+    try:
+        tenantId = tenant.tenantId
+        sourceResults = {}
+        for sourceName, metrics in getMetricsBySource().items():
+            query = compileSourceQuery(getMetricSource(sourceName), metrics, singleTenant=True)
+            sourceResults[sourceName] = runSourceQuery(sourceName, metrics, query, {"tenantId": tenantId})
+        return buildTenantMetrics(sourceResults, runLastActivityQuery([tenantId]), tenantId)
+    
+    except Exception as exception:
+        logException(exception, "Exception occurred while collecting metrics for tenant", tenant.tenantId)
+        return getStaleMetrics()
+
+def createEntryForRollout(tenant, metrics):
+    # build the roll_out_dashboard row of one tenant from its metrics keyed by column, the rows of a run are
+    # written together by writeRolloutEntries()
+    return [tenant.tenantId, tenant.projectcode, tenant.zone, tenant.circle, tenant.division, tenant.subdivision, tenant.section] + \
+           [metrics.get(column) for column in ROLLOUT_METRIC_COLUMNS]
+
+@instrumented
+def writeRolloutEntries(records, tableName=None, runId=None):
+    # write all collected rows with multi row INSERT statements of INSERT_PAGE_SIZE rows each and a single commit.
+    # rows of a full rebuild go to the staging table which publishStagingTable() swaps in once the load is done,
+    # with a runId the tenants are checkpointed in the same transaction as their rows
+    tableName = tableName or ROLLOUT_STAGING_TABLE
+    pageSize = int(os.getenv('INSERT_PAGE_SIZE', '1000'))
+    
+    print("inserting data into db", len(records))
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        
+        tzInfo = pytz.timezone('Asia/Kolkata')
+        createdTime = datetime.now(tz=tzInfo)
+        print("createdtime -->", createdTime)
+        
+        insertColumns = ROLLOUT_HEIRARCHY_COLUMNS + ROLLOUT_METRIC_COLUMNS + ['createdtime']
+        postgres_insert_query = "INSERT INTO " + tableName + " (" + ", ".join(insertColumns) + ") VALUES %s"
+        extras.execute_values(cursor, postgres_insert_query, [record + [createdTime] for record in records], page_size=pageSize)
+        if runId:
+            extras.execute_values(cursor, "INSERT INTO roll_out_dashboard_checkpoint (run_id, tenantid, completedtime) VALUES %s ON CONFLICT (run_id, tenantid) DO NOTHING",
+                                  [(runId, record[0], createdTime) for record in records], page_size=pageSize)
+       
+        connection.commit()
+        return True
+    
+    except (Exception, psycopg2.Error) as error:
+            logException(error)
+            return False
+   
+    finally:
+            if connection:
+                cursor.close()
+                releaseConnection(connection) 
+
+def process(shard=None, mergeShardCount=None, runId=None, resume=False, explain=False, asOf=None, asOfTo=None, columns=None):
+    print("continue is the process")
+    rolloutMode = 'explain' if explain else 'backfill' if asOf else os.getenv('ROLLOUT_MODE', 'tenant')
+    resetRunMetrics()
+    startRunBudget()
+    runStart = time.time()
+    published = False
+    # --resume continues the staging table of the run id, safe to pass on every run since a published run
+    # leaves no checkpoints behind
+    resume = resume or os.getenv('ROLLOUT_RESUME', 'false').lower() == 'true'
+    
+    try:
+        if not mergeShardCount:
+            checkReadReplica()
+        # --explain only reports the query plans
+        if explain:
+            published = explainQueries()
+        # --as-of DATE [--to DATE] writes the past days to roll_out_dashboard_snapshot, the live table is not touched
+        elif asOf:
+            published = backfillDashboard(asOf, asOfTo or asOf, columns)
+        # --shard i/n collects one slice of the tenants, --merge n publishes the run once its n shards are done
+        elif shard or mergeShardCount:
+            if rolloutMode == 'incremental':
+                raise ValueError("sharded runs need ROLLOUT_MODE tenant or bulk")
+            runId = getRunId(runId)
+            if mergeShardCount:
+                runSummary['shard'] = 'merge/' + str(mergeShardCount)
+                published = mergeShards(runId, mergeShardCount)
+            else:
+                shardIndex, shardCount = parseShard(shard)
+                runSummary['shard'] = str(shardIndex) + '/' + str(shardCount)
+                published = processShard(rolloutMode, runId, shardIndex, shardCount, resume)
+        # ROLLOUT_MODE=stream keeps the table current from the service events until it is stopped
+        elif rolloutMode == 'stream':
+            published = streamDashboard()
+        # ROLLOUT_MODE=incremental keeps the existing table and only folds in rows newer than the stored watermarks
+        elif rolloutMode == 'incremental':
+            published = refreshDashboard()
+        else:
+            published = rebuildDashboard(rolloutMode, getRunId(runId), resume)
+    finally:
+        printPoolWaitTimes()
+        writeRunReport(rolloutMode, runStart, published)
+        closeConnectionPool()
+    print("End of rollout dashboard")
+    return published
+
+def refreshDashboard():
+    tenants = getHeirarchyTenants()
+    if tenants is None:
+        return False
+    runSummary['tenantCount'] = len(tenants)
+    loadBillingSlabCounts(tenants)
+    checkActivityIndexes()
+    if not processIncremental(tenants):
+        return False
+    publishRollupTable()
+    writeSnapshot()
+    detectAnomalies()
+    return True
+
+def dropStaleRows(cursor, stagingTable, runId, tenantIds=None):
+    # rows written with carried forward cells are collected again by a resumed run
+    tenantCondition = " and tenantid = any(%(tenantIds)s)" if tenantIds is not None else ""
+    cursor.execute("delete from " + stagingTable + " where stale_columns is not null" + tenantCondition + " returning tenantid",
+                   {"tenantIds": tenantIds})
+    staleTenantIds = [row[0] for row in cursor.fetchall()]
+    if staleTenantIds:
+        print(len(staleTenantIds), "tenants with stale cells are collected again")
+        cursor.execute("delete from roll_out_dashboard_checkpoint where run_id = %s and tenantid = any(%s)", (runId, staleTenantIds))
+
+def rebuildDashboard(rolloutMode, runId, resume=False):
+    # full rebuilds are loaded into the staging table of the run and swapped in at the end, the live table stays
+    # readable meanwhile. tenants are checkpointed as their rows are written, a resumed run keeps the staging table
+    # and only collects the tenants missing in it
+    stagingTable = getRunStagingTable(runId)
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        
+        print("cursor: ",cursor)
+        
+        cursor.execute(CREATE_CHECKPOINT_TABLE_QUERY)
+        if not resume:
+            DROPPING_TABLE_QUERY = " drop table if exists " + stagingTable
+            cursor.execute(DROPPING_TABLE_QUERY)
+            cursor.execute("delete from roll_out_dashboard_checkpoint where run_id = %s", (runId,))
+        
+        createTableQuery = createTable(stagingTable)
+        cursor.execute(createTableQuery)
+        if resume:
+            dropStaleRows(cursor, stagingTable, runId)
+        completedTenantIds = getCompletedTenantIds(cursor, stagingTable, runId)
+        
+        connection.commit()
+        
+        print("staging table created")
+    except Exception as exception:
+        logException(exception)
+        return False
+            
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+    
+    tenants = getHeirarchyTenants()
+    if tenants is None:
+        return False
+    runSummary['tenantCount'] = len(tenants)
+    pendingTenants = [tenant for tenant in tenants if tenant.tenantId not in completedTenantIds]
+    if resume:
+        runSummary['resumedTenants'] = len(tenants) - len(pendingTenants)
+        print("resuming run", runId, "with", runSummary['resumedTenants'], "of", len(tenants), "tenants already written")
+    loadBillingSlabCounts(pendingTenants)
+    checkActivityIndexes()
+    # a failed load leaves the previous roll_out_dashboard published
+    if collectAndWriteRecords(pendingTenants, rolloutMode, stagingTable, runId) is None or not publishStagingTable(stagingTable, runId):
+        return False
+    writeSnapshot()
+    detectAnomalies()
+    return True
+
+def collectAndWriteRecords(tenants, rolloutMode, stagingTable, runId, restrictTenants=False):
+    # collect the rows of the tenants and write them to the staging table with their checkpoints, returns the
+    # number of rows written or None when a write failed.
+    # ROLLOUT_MODE=bulk computes every metric for all tenants in a handful of GROUP BY queries,
+    # the default per tenant mode runs each metric query separately for every tenant
+    if not tenants:
+        return 0
+    if rolloutMode == 'bulk':
+        records = buildRolloutRecords(processAllTenants(tenants, restrictTenants))
+        return len(records) if writeRolloutEntries(records, stagingTable, runId) else None
+    
+    # per tenant rows are written every CHECKPOINT_BATCH_SIZE tenants, so a run that dies keeps what it collected
+    batchSize = int(os.getenv('CHECKPOINT_BATCH_SIZE', '100'))
+    writtenCount = 0
+    tenantMetricsList = []
+    # TENANT_WORKERS tenants are collected at once, results are still written in heirarchy order
+    tenantWorkers = int(os.getenv('TENANT_WORKERS', '1'))
+    executor = ThreadPoolExecutor(max_workers=tenantWorkers)
+    try:
+        for tenant, metrics in zip(tenants, executor.map(collectTenantMetrics, tenants)):
+            if metrics is None:
+                continue
+            tenantMetricsList.append((tenant, metrics))
+            if len(tenantMetricsList) >= batchSize:
+                if not writeRolloutEntries(buildRolloutRecords(tenantMetricsList), stagingTable, runId):
+                    return None
+                writtenCount += len(tenantMetricsList)
+                tenantMetricsList = []
+        if not writeRolloutEntries(buildRolloutRecords(tenantMetricsList), stagingTable, runId):
+            return None
+        return writtenCount + len(tenantMetricsList)
+    finally:
+        # the tenants still queued are dropped when a write failed
+        executor.shutdown(wait=True, cancel_futures=True)
+
+CREATE_CHECKPOINT_TABLE_QUERY = """create table if not exists roll_out_dashboard_checkpoint(
+        run_id varchar(32) NOT NULL,
+        tenantid varchar(250) NOT NULL,
+        completedtime TIMESTAMP NOT NULL,
+        primary key (run_id, tenantid)
+        )"""
+
+def getCompletedTenantIds(cursor, stagingTable, runId, tenantIds=None):
+    # a tenant counts as written when it has a checkpoint and its row is in the staging table, checkpoints left
+    # behind by a staging table that is gone do not skip any tenant
+    tenantCondition = " and c.tenantid = any(%(tenantIds)s)" if tenantIds is not None else ""
+    cursor.execute("select c.tenantid from roll_out_dashboard_checkpoint c where c.run_id = %(runId)s" + tenantCondition +
+                   " and exists (select 1 from " + stagingTable + " s where s.tenantid = c.tenantid)", {"runId": runId, "tenantIds": tenantIds})
+    return set(row[0] for row in cursor.fetchall())
+
+# sharded runs: every pod started with --shard i/n collects the tenants whose stable hash falls into its slice and
+# writes them to the staging table of the run, roll_out_dashboard_shard records the finished shards and the pod
+# started with --merge n publishes the staging table once all n shards of the run are done
+CREATE_SHARD_TABLE_QUERY = """create table if not exists roll_out_dashboard_shard(
+        run_id varchar(32) NOT NULL,
+        shard integer NOT NULL,
+        shard_count integer NOT NULL,
+        status varchar(16) NOT NULL,
+        tenant_count NUMERIC(10),
+        lastmodifiedtime TIMESTAMP NOT NULL,
+        primary key (run_id, shard)
+        )"""
+
+def getRunId(runId=None):
+    # shards of one run share the run id, by default the date of the run so the pods of a nightly cronjob agree on it
+    runId = runId or os.getenv('ROLLOUT_RUN_ID') or datetime.now(tz=pytz.timezone('Asia/Kolkata')).strftime('%Y%m%d')
+    if not re.match(r'^[a-z0-9_]{1,24}$', runId):
+        raise ValueError("run id must be 1 to 24 lower case letters, digits or underscores: " + runId)
+    return runId
+
+def getRunStagingTable(runId):
+    return ROLLOUT_STAGING_TABLE + "_" + runId
+
+def getTenantShard(tenantId, shardCount):
+    # md5 instead of hash() so every pod puts a tenant into the same shard regardless of PYTHONHASHSEED
+    return int(hashlib.md5(tenantId.encode('utf-8')).hexdigest(), 16) % shardCount
+
+def parseShard(shard):
+    # "i/n" with 0 <= i < n
+    match = re.match(r'^(\d+)/(\d+)$', shard or '')
+    if not match or int(match.group(2)) < 1 or int(match.group(1)) >= int(match.group(2)):
+        raise ValueError("shard must look like i/n with 0 <= i < n: " + str(shard))
+    return int(match.group(1)), int(match.group(2))
+
+def setShardStatus(cursor, runId, shardIndex, shardCount, status, tenantCount=None):
+    cursor.execute("""INSERT INTO roll_out_dashboard_shard (run_id, shard, shard_count, status, tenant_count, lastmodifiedtime) VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (run_id, shard) DO UPDATE SET shard_count = excluded.shard_count, status = excluded.status, tenant_count = excluded.tenant_count,
+        lastmodifiedtime = excluded.lastmodifiedtime""",
+                   (runId, shardIndex, shardCount, status, tenantCount, datetime.now(tz=pytz.timezone('Asia/Kolkata'))))
+
+@instrumented
+def prepareShardStaging(stagingTable, runId, shardIndex, shardCount, tenantIds, resume=False):
+    # create the staging table of the run if this is the first shard to start and remove the rows a previous attempt
+    # of this shard left in it, so a failed shard can simply be started again. a resumed shard keeps them instead.
+    # returns the checkpointed tenantids of the shard, None on failure
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        
+        # shards starting together would race on create table if not exists
+        cursor.execute("select pg_advisory_xact_lock(hashtext(%s))", (stagingTable,))
+        cursor.execute(CREATE_SHARD_TABLE_QUERY)
+        cursor.execute("select distinct shard_count from roll_out_dashboard_shard where run_id = %s", (runId,))
+        shardCounts = [row[0] for row in cursor.fetchall()]
+        if shardCounts and shardCounts != [shardCount]:
+            raise Exception("run " + runId + " was started with " + str(shardCounts) + " shards, use a new run id to change the shard count")
+        cursor.execute(createTable(stagingTable))
+        cursor.execute(CREATE_CHECKPOINT_TABLE_QUERY)
+        if not resume:
+            cursor.execute("delete from " + stagingTable + " where tenantid = any(%s)", (tenantIds,))
+            cursor.execute("delete from roll_out_dashboard_checkpoint where run_id = %s and tenantid = any(%s)", (runId, tenantIds))
+        else:
+            dropStaleRows(cursor, stagingTable, runId, tenantIds)
+        completedTenantIds = getCompletedTenantIds(cursor, stagingTable, runId, tenantIds)
+        setShardStatus(cursor, runId, shardIndex, shardCount, 'running')
+        connection.commit()
+        return completedTenantIds
+    
+    except Exception as exception:
+        logException(exception)
+        return None
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+
+def finishShard(runId, shardIndex, shardCount, tenantCount):
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        setShardStatus(cursor, runId, shardIndex, shardCount, 'done', tenantCount)
+        connection.commit()
+        return True
+    
+    except Exception as exception:
+        logException(exception)
+        return False
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+
+def processShard(rolloutMode, runId, shardIndex, shardCount, resume=False):
+    # collect one slice of the tenants into the shared staging table of the run, publishing is left to mergeShards()
+    stagingTable = getRunStagingTable(runId)
+    print("processing shard", shardIndex, "of", shardCount, "for run", runId)
+    tenants = getHeirarchyTenants()
+    if tenants is None:
+        return False
+    tenants = [tenant for tenant in tenants if getTenantShard(tenant.tenantId, shardCount) == shardIndex]
+    runSummary['tenantCount'] = len(tenants)
+    completedTenantIds = prepareShardStaging(stagingTable, runId, shardIndex, shardCount, [tenant.tenantId for tenant in tenants], resume)
+    if completedTenantIds is None:
+        return False
+    pendingTenants = [tenant for tenant in tenants if tenant.tenantId not in completedTenantIds]
+    if resume:
+        runSummary['resumedTenants'] = len(completedTenantIds)
+        print("resuming shard with", len(completedTenantIds), "of", len(tenants), "tenants already written")
+    loadBillingSlabCounts(pendingTenants)
+    # concurrent index builds of several pods would collide, only the first shard provisions them
+    checkActivityIndexes(provision=shardIndex == 0)
+    writtenCount = collectAndWriteRecords(pendingTenants, rolloutMode, stagingTable, runId, restrictTenants=True)
+    if writtenCount is None:
+        return False
+    return finishShard(runId, shardIndex, shardCount, len(completedTenantIds) + writtenCount)
+
+@instrumented
+def mergeShards(runId, shardCount):
+    # publish the staging table of the run once every shard finished, a missing or failed shard leaves the
+    # previous roll_out_dashboard published and the merge can be started again after that shard is rerun
+    stagingTable = getRunStagingTable(runId)
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        cursor.execute(CREATE_SHARD_TABLE_QUERY)
+        cursor.execute("select shard, shard_count, status, tenant_count from roll_out_dashboard_shard where run_id = %s", (runId,))
+        shardRows = cursor.fetchall()
+        connection.commit()
+    
+    except Exception as exception:
+        logException(exception)
+        return False
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+    
+    doneShards = set(shard for shard, count, status, _ in shardRows if status == 'done' and count == shardCount)
+    missingShards = sorted(set(range(shardCount)) - doneShards)
+    if missingShards:
+        print("run", runId, "is missing shards", missingShards, "of", shardCount, ", nothing published")
+        return False
+    runSummary['tenantCount'] = sum(int(tenantCount or 0) for _, _, _, tenantCount in shardRows)
+    print("merging", shardCount, "shards of run", runId, "with", runSummary['tenantCount'], "tenants")
+    
+    if not publishStagingTable(stagingTable, runId):
+        return False
+    
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        cursor.execute("update roll_out_dashboard_shard set status = 'published', lastmodifiedtime = %s where run_id = %s",
+                       (datetime.now(tz=pytz.timezone('Asia/Kolkata')), runId))
+        connection.commit()
+    
+    except Exception as exception:
+        logException(exception)
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+    writeSnapshot()
+    detectAnomalies()
+    return True
+
+# diagnostic mode (app.py --explain): every metric query is run with EXPLAIN (ANALYZE, BUFFERS) for a sample of tenants
+# and the plans are written to EXPLAIN_REPORT with their timings and buffer counts. the all tenant forms would scan the
+# whole source tables, they only get a plain EXPLAIN unless EXPLAIN_ANALYZE_ALL is set. sequential scans over tables of
+# more than EXPLAIN_LARGE_TABLE_ROWS rows are flagged, nothing is written to roll_out_dashboard
+def getExplainSample(tenantIds):
+    # the same tenants are sampled on every run so successive reports can be compared
+    sampleSize = int(os.getenv('EXPLAIN_SAMPLE_TENANTS', '3'))
+    return sorted(tenantIds, key=lambda tenantId: hashlib.md5(tenantId.encode('utf-8')).hexdigest())[:sampleSize]
+
+def findSeqScans(plan, scans=None):
+    # Seq Scan nodes of a FORMAT JSON plan with the rows they read, filtered out rows included. a plan that was not
+    # analyzed only has the estimated rows left after the filter
+    scans = [] if scans is None else scans
+    if plan.get('Node Type') == 'Seq Scan':
+        if 'Actual Rows' in plan:
+            rowsScanned = int((plan['Actual Rows'] + plan.get('Rows Removed by Filter', 0)) * plan.get('Actual Loops', 1))
+        else:
+            rowsScanned = int(plan.get('Plan Rows', 0))
+        scans.append({"relation": plan.get('Relation Name'),
+                      "rowsScanned": rowsScanned,
+                      "actualTotalMs": plan.get('Actual Total Time')})
+    for child in plan.get('Plans', []):
+        findSeqScans(child, scans)
+    return scans
+
+def explainQuery(connection, label, query, parameters, analyze=True):
+    cursor = connection.cursor()
+    entry = dict(label, analyzed=analyze)
+    try:
+        cursor.execute("set local statement_timeout = %s", (getStatementTimeout(),))
+        cursor.execute(("explain (analyze, buffers, format json) " if analyze else "explain (format json) ") + query, parameters)
+        result = cursor.fetchone()[0][0]
+        plan = result['Plan']
+        entry.update({"totalCost": plan.get('Total Cost'),
+                      "planningMs": result.get('Planning Time'),
+                      "executionMs": result.get('Execution Time'),
+                      "sharedHitBlocks": plan.get('Shared Hit Blocks'),
+                      "sharedReadBlocks": plan.get('Shared Read Blocks'),
+                      "seqScans": findSeqScans(plan),
+                      "query": query,
+                      "plan": plan})
+    except Exception as exception:
+        logException(exception, "query could not be explained", label)
+        entry["error"] = str(exception)
+    finally:
+        # EXPLAIN ANALYZE executes the query, nothing of it is kept
+        connection.rollback()
+        cursor.close()
+    return entry
+
+@instrumented
+def explainQueries():
+    tenants = getHeirarchyTenants()
+    if tenants is None:
+        return False
+    runSummary['tenantCount'] = len(tenants)
+    checkActivityIndexes(provision=False)
+    tenantIds = [tenant.tenantId for tenant in tenants]
+    sampleTenantIds = getExplainSample(tenantIds)
+    print("explaining the metric queries for tenants", sampleTenantIds)
+    analyzeAll = os.getenv('EXPLAIN_ANALYZE_ALL', 'false').lower() == 'true'
+    
+    entries = []
+    connection = None
+    role = getReadRole()
+    try:
+        connection = getConnection(role)
+        for sourceName, metrics in getMetricsBySource().items():
+            source = getMetricSource(sourceName)
+            # per tenant mode runs the single tenant form, bulk mode the GROUP BY form over all tenants and shards
+            # the one over their tenant list
+            for tenantId in sampleTenantIds:
+                entries.append(explainQuery(connection, {"source": sourceName, "form": "tenant", "tenantId": tenantId},
+                                            compileSourceQuery(source, metrics, singleTenant=True), {"tenantId": tenantId}))
+            entries.append(explainQuery(connection, {"source": sourceName, "form": "tenantList", "tenantCount": len(sampleTenantIds)},
+                                        compileSourceQuery(source, metrics, tenantList=True), {"tenantIds": sampleTenantIds}))
+            entries.append(explainQuery(connection, {"source": sourceName, "form": "all"}, compileSourceQuery(source, metrics), {}, analyzeAll))
+        for tenantId in sampleTenantIds:
+            entries.append(explainQuery(connection, {"source": "last_activity", "form": "tenant", "tenantId": tenantId},
+                                        compileLastActivityQuery(), {"tenantIds": [tenantId]}))
+        entries.append(explainQuery(connection, {"source": "last_activity", "form": "all", "tenantCount": len(tenantIds)},
+                                    compileLastActivityQuery(), {"tenantIds": tenantIds}, analyzeAll))
+        
+        # reltuples covers tables whose scan stopped early, the scanned rows cover tables never analyzed
+        relations = sorted(set(scan["relation"] for entry in entries for scan in entry.get("seqScans", [])))
+        cursor = connection.cursor()
+        cursor.execute("select relation, coalesce((select reltuples from pg_class where oid = to_regclass(relation)), 0) from unnest(%s::text[]) as relation",
+                       (relations,))
+        tableRows = dict((relation, int(max(rows, 0))) for relation, rows in cursor.fetchall())
+        connection.rollback()
+        cursor.close()
+    
+    except Exception as exception:
+        logException(exception)
+        return False
+    
+    finally:
+        if connection:
+            releaseConnection(connection, role)
+    
+    largeTableRows = int(os.getenv('EXPLAIN_LARGE_TABLE_ROWS', '100000'))
+    flagged = []
+    for entry in entries:
+        for scan in entry.get("seqScans", []):
+            scan["tableRows"] = max(tableRows.get(scan["relation"], 0), scan["rowsScanned"])
+            if scan["tableRows"] > largeTableRows:
+                flagged.append({"source": entry["source"], "form": entry["form"], "tenantId": entry.get("tenantId"),
+                                "relation": scan["relation"], "tableRows": scan["tableRows"], "actualTotalMs": scan["actualTotalMs"]})
+    
+    report = {"generatedTime": datetime.now(tz=pytz.timezone('Asia/Kolkata')).isoformat(),
+              "readFrom": runSummary.get('readFrom', 'primary'),
+              "largeTableRows": largeTableRows,
+              "sampleTenants": sampleTenantIds,
+              "missingIndexes": runSummary.get('missingIndexes', []),
+              "flaggedSeqScans": flagged,
+              "queries": entries}
+    for entry in entries:
+        print("  %-24s %-10s %-20s cost %12s  execution ms %10s  shared hit %8s  read %8s%s" % (entry["source"], entry["form"], entry.get("tenantId") or "",
+              entry.get("totalCost"), entry.get("executionMs"), entry.get("sharedHitBlocks"), entry.get("sharedReadBlocks"), "  ERROR" if "error" in entry else ""))
+    for scan in flagged:
+        print("sequential scan of", scan["relation"], "(" + str(scan["tableRows"]), "rows) in", scan["source"], scan["form"], "query")
+    
+    reportFile = os.getenv('EXPLAIN_REPORT', 'rollout-dashboard-explain.json')
+    try:
+        writeFileAtomically(reportFile, json.dumps(report, indent=2, default=str))
+    except IOError as exception:
+        logException(exception, "explain report could not be written")
+        return False
+    print("explain report written to", reportFile)
+    return not any("error" in entry for entry in entries)
+
+# event stream mode (ROLLOUT_MODE=stream): the create events of connections, payments, demands and challans are read
+# from kafka or from the file based stand in and folded into per tenant counters and last dates in memory, which are
+# added to roll_out_dashboard every STREAM_FLUSH_SECONDS. an event counts when its createdTime is past the tenant's
+# watermark for the table, or without one past the time the tenant's row was rebuilt, and a flush moves the watermark
+# up to the latest counted event so incremental runs carry on after it. events arriving after a newer one of the same
+# tenant and table was flushed, status changes of counted rows and tenants without a row yet wait for the next rebuild
+StreamRule = namedtuple('StreamRule', ['watermark', 'column', 'aggregate', 'value', 'condition'])
+
+def isWaterPayment(record):
+    return record['businessService'] == 'WS'
+
+def isActiveDemand(record):
+    return record['status'] == 'ACTIVE'
+
+# the stream counterpart of METRIC_REGISTRY and LAST_ACTIVITY_METRICS, keyed by the watermark name of the table the
+# record belongs to. count rules add 1, sum rules the value, breakdown rules a {key: amount} object and max rules a date
+STREAM_RULES = [
+    StreamRule('eg_ws_connection', 'consumer_created_count', 'count', None, lambda record: record['status'] == 'Active'),
+    StreamRule('egcl_paymentdetail', 'collection_till_date', 'sum', lambda record: record['amount'], isWaterPayment),
+    StreamRule('egcl_paymentdetail', 'collection_till_date_online', 'sum', lambda record: record['amount'],
+               lambda record: isWaterPayment(record) and record['paymentMode'] == 'ONLINE'),
+    StreamRule('egcl_paymentdetail', 'collection_by_payment_mode', 'breakdown',
+               lambda record: {record['paymentMode'] or 'UNKNOWN': float(record['amount'])}, isWaterPayment),
+    StreamRule('egcl_paymentdetail', 'last_collection_date', 'max', None, isWaterPayment),
+    StreamRule('egbs_demand_v1', 'demands_till_date_count', 'count', None, lambda record: isActiveDemand(record) and record['businessService'] == 'WS'),
+    StreamRule('egbs_demand_v1', 'last_demand_gen_date', 'max', None, None),
+    StreamRule('egbs_demanddetail_v1', 'total_advance', 'sum', lambda record: record['amount'],
+               lambda record: isActiveDemand(record) and record['taxHeadCode'] == 'WS_ADVANCE_CARRYFORWARD'),
+    StreamRule('egbs_demanddetail_v1', 'total_penalty', 'sum', lambda record: record['amount'],
+               lambda record: isActiveDemand(record) and record['taxHeadCode'] == 'WS_TIME_PENALTY'),
+    StreamRule('eg_echallan', 'expense_count', 'count', None, None),
+    StreamRule('eg_echallan', 'paid_status_expense_bill_count', 'count', None, lambda record: record['applicationStatus'] == 'PAID'),
+    StreamRule('eg_echallan', 'last_expense_txn_date', 'max', None, None)
+]
+
+def asList(value):
+    return value if isinstance(value, list) else ([value] if value else [])
+
+def getAuditCreatedTime(entity):
+    return (entity.get('auditDetails') or {}).get('createdTime')
+
+# the event payloads are the request bodies the services publish, turned into (watermark name, record) pairs
+def extractConnectionRecords(payload):
+    for connection in asList(payload.get('WaterConnection')):
+        yield 'eg_ws_connection', {"id": connection.get('id'), "tenantId": connection.get('tenantId'), "createdTime": getAuditCreatedTime(connection),
+                                   "status": connection.get('status')}
+
+def extractPaymentRecords(payload):
+    for payment in asList(payload.get('Payment')):
+        for detail in payment.get('paymentDetails') or []:
+            yield 'egcl_paymentdetail', {"id": detail.get('id'), "tenantId": detail.get('tenantId') or payment.get('tenantId'),
+                                         "createdTime": getAuditCreatedTime(detail) or getAuditCreatedTime(payment),
+                                         "businessService": detail.get('businessService'), "amount": detail.get('totalAmountPaid') or 0,
+                                         "paymentMode": payment.get('paymentMode')}
+
+def extractDemandRecords(payload):
+    # update events repeat the demand with the penalties added to it, the parts counted before are behind the watermark
+    # or, within the same flush, recognised by their id
+    for demand in asList(payload.get('Demands')):
+        yield 'egbs_demand_v1', {"id": demand.get('id'), "tenantId": demand.get('tenantId'), "createdTime": getAuditCreatedTime(demand),
+                                 "businessService": demand.get('businessService'), "status": demand.get('status')}
+        for detail in demand.get('demandDetails') or []:
+            if detail.get('taxHeadMasterCode') in ('WS_ADVANCE_CARRYFORWARD', 'WS_TIME_PENALTY'):
+                yield 'egbs_demanddetail_v1', {"id": detail.get('id'), "tenantId": demand.get('tenantId'),
+                                               "createdTime": getAuditCreatedTime(detail) or getAuditCreatedTime(demand),
+                                               "taxHeadCode": detail.get('taxHeadMasterCode'), "amount": detail.get('taxAmount') or 0,
+                                               "status": demand.get('status')}
+
+def extractChallanRecords(payload):
+    for challan in asList(payload.get('Challan') or payload.get('challan')):
+        yield 'eg_echallan', {"id": challan.get('id'), "tenantId": challan.get('tenantId'), "createdTime": getAuditCreatedTime(challan),
+                              "applicationStatus": challan.get('applicationStatus')}
+
+STREAM_EVENT_EXTRACTORS = {
+    'connection': extractConnectionRecords,
+    'payment': extractPaymentRecords,
+    'demand': extractDemandRecords,
+    'challan': extractChallanRecords
+}
+
+def getStreamTopics():
+    # STREAM_TOPICS lists kind:topic pairs, a kind can be read from more than one topic
+    topics = {}
+    for entry in os.getenv('STREAM_TOPICS', 'connection:save-ws-connection,payment:egov.collection.payment-create,demand:save-demand,'
+                                            'demand:update-demand,challan:save-challan').split(','):
+        kind, _, topic = entry.strip().partition(':')
+        if kind not in STREAM_EVENT_EXTRACTORS or not topic:
+            raise ValueError("STREAM_TOPICS entries must look like kind:topic with kind one of " + ", ".join(sorted(STREAM_EVENT_EXTRACTORS)) + ": " + entry)
+        topics[topic] = kind
+    return topics
+
+CREATE_STREAM_OFFSET_TABLE_QUERY = """create table if not exists roll_out_dashboard_stream_offset(
+        topic varchar(250) primary key,
+        position BIGINT NOT NULL,
+        lastmodifiedtime TIMESTAMP NOT NULL
+        )"""
+
+def pollFileEvents(eventDirectory, offsets, maxEvents):
+    # file based stand in for the broker: producers append one JSON payload per line to <topic>.jsonl in
+    # EVENT_STREAM_DIR, the read positions are advanced in place and stored with every flush
+    events = []
+    for topic in sorted(offsets):
+        eventFileName = os.path.join(eventDirectory, topic + '.jsonl')
+        if not os.path.exists(eventFileName):
+            continue
+        with open(eventFileName, 'rb') as eventFile:
+            eventFile.seek(offsets[topic])
+            for line in eventFile:
+                # a line without its newline is still being written
+                if not line.endswith(b'\n') or len(events) >= maxEvents:
+                    break
+                offsets[topic] += len(line)
+                if line.strip():
+                    events.append((topic, line))
+    return events
+
+def openEventStream(topics, offsets):
+    # returns poll(timeoutSeconds) giving (topic, message) pairs and commit() called once a flush is stored
+    maxEvents = int(os.getenv('STREAM_POLL_MAX_EVENTS', '10000'))
+    if os.getenv('EVENT_STREAM_BROKER', 'file') == 'kafka':
+        if KafkaConsumer is None:
+            raise ValueError("EVENT_STREAM_BROKER=kafka needs the kafka-python package")
+        consumer = KafkaConsumer(*sorted(topics), bootstrap_servers=os.getenv('KAFKA_BOOTSTRAP_SERVERS', 'localhost:9092').split(','),
+                                 group_id=os.getenv('KAFKA_GROUP_ID', 'rollout-dashboard'), enable_auto_commit=False, auto_offset_reset='earliest')
+        def pollKafka(timeoutSeconds):
+            batches = consumer.poll(timeout_ms=int(timeoutSeconds * 1000), max_records=maxEvents)
+            return [(message.topic, message.value) for messages in batches.values() for message in messages]
+        return pollKafka, consumer.commit, consumer.close
+    
+    eventDirectory = os.getenv('EVENT_STREAM_DIR', '/tmp/rollout-dashboard-events')
+    def pollFile(timeoutSeconds):
+        events = pollFileEvents(eventDirectory, offsets, maxEvents)
+        if not events:
+            time.sleep(timeoutSeconds)
+        return events
+    return pollFile, lambda: None, lambda: None
+
+def loadStreamAnchors(cursor, stream):
+    # watermarks and the rebuild time of every row, in epoch millis like the createdtime of the source tables.
+    # createdtime holds the IST wall clock of the write
+    cursor.execute("select tenantid, round(extract(epoch from createdtime at time zone 'Asia/Kolkata') * 1000)::bigint from roll_out_dashboard")
+    stream['rowTimes'] = dict(cursor.fetchall())
+    cursor.execute("select tenantid, sourcetable, watermark from roll_out_dashboard_watermark")
+    stream['watermarks'] = dict(((tenantId, sourceTable), watermark) for tenantId, sourceTable, watermark in cursor.fetchall())
+
+def getStreamAnchor(stream, tenantId, watermarkName):
+    return stream['watermarks'].get((tenantId, watermarkName), stream['rowTimes'].get(tenantId))
+
+def applyStreamEvent(stream, kind, message):
+    # fold the records of one event into the pending counters of their (tenant, table), records already counted
+    # by a batch run or a previous flush are skipped and so are repeated ids until the next flush
+    try:
+        payload = json.loads(message, parse_float=Decimal)
+        records = list(STREAM_EVENT_EXTRACTORS[kind](payload))
+    except Exception as exception:
+        logException(exception, "stream event could not be read", message[:200])
+        runSummary['streamInvalidEvents'] = runSummary.get('streamInvalidEvents', 0) + 1
+        return
+    runSummary['streamEvents'] = runSummary.get('streamEvents', 0) + 1
+    for watermarkName, record in records:
+        anchor = getStreamAnchor(stream, record['tenantId'], watermarkName)
+        if anchor is None or record['createdTime'] is None or record['createdTime'] <= anchor:
+            runSummary['streamSkippedRecords'] = runSummary.get('streamSkippedRecords', 0) + 1
+            continue
+        bucket = stream['pending'].setdefault((record['tenantId'], watermarkName),
+                                              {"anchor": anchor, "minCreated": record['createdTime'], "maxCreated": record['createdTime'], "values": {}, "ids": set()})
+        if record['id'] is not None:
+            if record['id'] in bucket['ids']:
+                continue
+            bucket['ids'].add(record['id'])
+        bucket['minCreated'] = min(bucket['minCreated'], record['createdTime'])
+        bucket['maxCreated'] = max(bucket['maxCreated'], record['createdTime'])
+        for rule in STREAM_RULES:
+            if rule.watermark != watermarkName or (rule.condition and not rule.condition(record)):
+                continue
+            if rule.aggregate == 'max':
+                value = datetime.fromtimestamp(record['createdTime'] / 1000.0)
+                bucket['values'][rule.column] = max(bucket['values'].get(rule.column, value), value)
+            else:
+                value = 1 if rule.aggregate == 'count' else rule.value(record)
+                bucket['values'][rule.column] = mergeIncrementalValue(rule.aggregate, bucket['values'].get(rule.column), value)
+
+@instrumented
+def flushStreamCounters(stream):
+    # add the pending counters to roll_out_dashboard and move the watermarks past them in one transaction, together
+    # with the file positions of the stand in broker. a (tenant, table) whose anchor moved since its events were
+    # taken, because a batch run counted them meanwhile, is dropped unless all of its events are past the new anchor
+    aggregates = dict((rule.column, rule.aggregate) for rule in STREAM_RULES)
+    columns = sorted(aggregates)
+    pending = stream['pending']
+    tenantIds = sorted(set(tenantId for tenantId, _ in pending))
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        
+        cursor.execute("select tenantid, " + ", ".join(columns) + ", round(extract(epoch from createdtime at time zone 'Asia/Kolkata') * 1000)::bigint " +
+                       "from roll_out_dashboard where tenantid = any(%s) for update", (tenantIds,))
+        rows = dict((row[0], dict(zip(columns + ['rowTime'], row[1:]))) for row in cursor.fetchall())
+        cursor.execute("select tenantid, sourcetable, watermark from roll_out_dashboard_watermark where tenantid = any(%s)", (tenantIds,))
+        watermarks = dict(((tenantId, sourceTable), watermark) for tenantId, sourceTable, watermark in cursor.fetchall())
+        
+        changedTenantIds = set()
+        newWatermarks = {}
+        for (tenantId, watermarkName), bucket in pending.items():
+            row = rows.get(tenantId)
+            anchor = watermarks.get((tenantId, watermarkName), row['rowTime']) if row else None
+            if anchor is None or (anchor != bucket['anchor'] and anchor >= bucket['minCreated']):
+                print("stream counters of", tenantId, watermarkName, "dropped, the tenant was rebuilt or refreshed meanwhile")
+                runSummary['streamDroppedCounters'] = runSummary.get('streamDroppedCounters', 0) + 1
+                continue
+            for column, value in bucket['values'].items():
+                row[column] = mergeIncrementalValue(aggregates[column], row[column], value)
+            newWatermarks[(tenantId, watermarkName)] = bucket['maxCreated']
+            changedTenantIds.add(tenantId)
+        
+        tzInfo = pytz.timezone('Asia/Kolkata')
+        modifiedTime = datetime.now(tz=tzInfo)
+        pageSize = int(os.getenv('INSERT_PAGE_SIZE', '1000'))
+        extras.execute_batch(cursor, "update roll_out_dashboard set " + ", ".join(column + " = %s" for column in columns) + " where tenantid = %s",
+                             [[rows[tenantId][column] for column in columns] + [tenantId] for tenantId in sorted(changedTenantIds)], page_size=pageSize)
+        extras.execute_values(cursor, WATERMARK_UPSERT_QUERY, [(tenantId, watermarkName, watermark, modifiedTime)
+                                                               for (tenantId, watermarkName), watermark in newWatermarks.items()], page_size=pageSize)
+        if stream['offsets']:
+            extras.execute_values(cursor, """INSERT INTO roll_out_dashboard_stream_offset (topic, position, lastmodifiedtime) VALUES %s
+                ON CONFLICT (topic) DO UPDATE SET position = excluded.position, lastmodifiedtime = excluded.lastmodifiedtime""",
+                                  [(topic, position, modifiedTime) for topic, position in stream['offsets'].items()])
+        loadStreamAnchors(cursor, stream)
+        connection.commit()
+        pending.clear()
+        runSummary['streamFlushes'] = runSummary.get('streamFlushes', 0) + 1
+        print("stream flush:", len(changedTenantIds), "tenants updated")
+        return changedTenantIds
+    
+    except Exception as exception:
+        logException(exception, "stream counters could not be flushed, they are kept for the next flush")
+        if connection:
+            connection.rollback()
+        return None
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+
+def streamDashboard():
+    # runs for STREAM_RUN_SECONDS (0 until stopped with SIGTERM / ctrl-c), the counters are flushed on the way out
+    topics = getStreamTopics()
+    stream = {"pending": {}, "offsets": {}, "rowTimes": {}, "watermarks": {}}
+    useFileBroker = os.getenv('EVENT_STREAM_BROKER', 'file') != 'kafka'
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        cursor.execute(CREATE_WATERMARK_TABLE_QUERY)
+        cursor.execute(CREATE_STREAM_OFFSET_TABLE_QUERY)
+        if useFileBroker:
+            cursor.execute("select topic, position from roll_out_dashboard_stream_offset where topic = any(%s)", (sorted(topics),))
+            stream['offsets'] = dict((topic, 0) for topic in topics)
+            stream['offsets'].update(cursor.fetchall())
+        loadStreamAnchors(cursor, stream)
+        connection.commit()
+    
+    except Exception as exception:
+        logException(exception, "stream mode needs a published roll_out_dashboard, run a full rebuild first")
+        return False
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+    
+    runSummary['tenantCount'] = len(stream['rowTimes'])
+    poll, commit, close = openEventStream(topics, stream['offsets'])
+    stopping = threading.Event()
+    try:
+        signal.signal(signal.SIGTERM, lambda signalNumber, frame: stopping.set())
+    except ValueError:
+        # signals can only be handled on the main thread
+        pass
+    
+    flushSeconds = float(os.getenv('STREAM_FLUSH_SECONDS', '60'))
+    runSeconds = float(os.getenv('STREAM_RUN_SECONDS', '0'))
+    pollSeconds = float(os.getenv('STREAM_POLL_SECONDS', '1'))
+    streamStart = time.time()
+    nextFlush = streamStart + flushSeconds
+    print("consuming", ", ".join(sorted(topics)), "from", "kafka" if not useFileBroker else "the event files")
+    flushed = True
+    try:
+        while not stopping.is_set() and (runSeconds <= 0 or time.time() - streamStart < runSeconds):
+            for topic, message in poll(pollSeconds):
+                applyStreamEvent(stream, topics[topic], message)
+            if time.time() >= nextFlush:
+                flushed = flushStream(stream, commit)
+                nextFlush = time.time() + flushSeconds
+    except KeyboardInterrupt:
+        print("stopping the event stream")
+    finally:
+        flushed = flushStream(stream, commit)
+        close()
+    return flushed
+
+def flushStream(stream, commit):
+    changedTenantIds = flushStreamCounters(stream)
+    if changedTenantIds is None:
+        return False
+    # broker offsets are committed after the counters are stored, a crash in between replays the events and the
+    # watermarks skip the ones already counted
+    commit()
+    if changedTenantIds:
+        publishRollupTable()
+    return True
+
+# point in time backfill (app.py --as-of DATE [--to DATE]): the dashboard as it stood at the end of each day of the range
+# is written to roll_out_dashboard_snapshot. every metric is bounded by the createdtime of its watermark and every
+# source table is scanned once for the whole range, grouped by tenant and IST day with the rows before the first day in
+# one bucket, the daily rows are the running totals over those buckets. statuses are the current ones, the employee count
+# and the billing slabs have no history and stay empty, existing snapshot rows are kept unless --columns names the
+# columns to overwrite in them
+IST_OFFSET_MILLIS = 19800000
+DAY_MILLIS = 86400000
+EPOCH_DATE = datetime(1970, 1, 1).date()
+
+def getDayBucket(timeColumn):
+    # IST day number of an epoch millis column, days before %(firstDay)s fold into the day before it
+    return "greatest(%(firstDay)s - 1, floor((" + timeColumn + " + " + str(IST_OFFSET_MILLIS) + ") / " + str(DAY_MILLIS) + ")::int)"
+
+def compileActivityBucketQuery(metric):
+    condition = " and " + metric.condition if metric.condition else ""
+    return "select tenantid, " + getDayBucket("createdtime") + ", max(createdtime) from " + metric.table + \
+           " where createdtime <= %(asOfBound)s" + condition + " group by 1, 2"
+
+def getBackfillJobs(columns=None):
+    # (source name, metrics, bucketed query) for every table scan of the backfill, restricted to the given columns
+    jobs = []
+    for sourceName, metrics in getMetricsBySource().items():
+        source = getMetricSource(sourceName)
+        if not source.watermarks:
+            print("metrics of", sourceName, "have no createdtime and are not backfilled")
+            continue
+        for watermarkName, watermarkMetrics in getMetricsByWatermark(source, metrics).items():
+            watermarkMetrics = [metric for metric in watermarkMetrics if columns is None or metric.column in columns]
+            if watermarkMetrics:
+                jobs.append((sourceName, watermarkMetrics, compileSourceQuery(source, watermarkMetrics, asOfWatermark=watermarkName)))
+    for activity in LAST_ACTIVITY_METRICS:
+        if columns is None or activity.column in columns:
+            jobs.append((activity.table, [Metric(activity.column, activity.table, 'max', 'createdtime', activity.condition)],
+                         compileActivityBucketQuery(activity)))
+    return jobs
+
+def createSnapshotPartitions(cursor, firstDate, lastDate):
+    monthStart = firstDate.replace(day=1)
+    while monthStart <= lastDate:
+        cursor.execute("create table if not exists " + getSnapshotPartitionName(monthStart) + " partition of roll_out_dashboard_snapshot for values from (%s) to (%s)",
+                       (monthStart, monthStart + relativedelta(months=1)))
+        monthStart += relativedelta(months=1)
+
+@instrumented
+def backfillDashboard(firstDate, lastDate, columns=None):
+    if lastDate < firstDate:
+        raise ValueError("--to must not be before --as-of")
+    unknownColumns = sorted(set(columns or []) - set(ROLLOUT_METRIC_COLUMNS))
+    if unknownColumns:
+        raise ValueError("unknown dashboard columns " + ", ".join(unknownColumns))
+    retainedFrom = datetime.now(tz=pytz.timezone('Asia/Kolkata')).date().replace(day=1) - relativedelta(months=int(os.getenv('SNAPSHOT_RETENTION_MONTHS', '24')))
+    if firstDate < retainedFrom:
+        print("days before", retainedFrom, "are dropped again by the next snapshot, raise SNAPSHOT_RETENTION_MONTHS to keep them")
+    tenants = getHeirarchyTenants()
+    if tenants is None:
+        return False
+    runSummary['tenantCount'] = len(tenants)
+    firstDay = (firstDate - EPOCH_DATE).days
+    lastDay = (lastDate - EPOCH_DATE).days
+    parameters = {"firstDay": firstDay, "asOfBound": (lastDay + 1) * DAY_MILLIS - IST_OFFSET_MILLIS - 1}
+    print("backfilling", firstDate, "to", lastDate, "for", len(tenants), "tenants")
+    
+    # the table scans run in parallel on the read connections
+    jobs = getBackfillJobs(columns)
+    executor = ThreadPoolExecutor(max_workers=int(os.getenv('BACKFILL_WORKERS', '2')))
+    try:
+        results = list(executor.map(lambda job: runSourceQuery(job[0], job[1], job[2], parameters, dayBuckets=True), jobs))
+    finally:
+        executor.shutdown(wait=True)
+    if any(result is None for result in results):
+        print("a backfill scan failed, nothing written")
+        return False
+    
+    aggregates = {}
+    bucketsByTenant = {}
+    for (_, metrics, _), result in zip(jobs, results):
+        for metric in metrics:
+            aggregates[metric.column] = metric
+        for (tenantId, day), values in result.items():
+            bucketsByTenant.setdefault(tenantId, {}).setdefault(day, {}).update(values)
+    
+    snapshotColumns = ROLLOUT_HEIRARCHY_COLUMNS + ROLLOUT_METRIC_COLUMNS + ['createdtime']
+    if columns:
+        conflictAction = "DO UPDATE SET " + ", ".join(column + " = excluded." + column for column in columns)
+    else:
+        conflictAction = "DO NOTHING"
+    insertQuery = "INSERT INTO roll_out_dashboard_snapshot (snapshot_date, " + ", ".join(snapshotColumns) + ") VALUES %s ON CONFLICT (tenantid, snapshot_date) " + conflictAction
+    pageSize = int(os.getenv('INSERT_PAGE_SIZE', '1000'))
+    createdTime = datetime.now(tz=pytz.timezone('Asia/Kolkata'))
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        cursor.execute(createSnapshotTable())
+        for columnQuery in getAddColumnQueries('roll_out_dashboard_snapshot'):
+            cursor.execute(columnQuery)
+        createSnapshotPartitions(cursor, firstDate, lastDate)
+        
+        # the days of one tenant are built from its buckets and written before the next tenant is started
+        writtenCount = 0
+        for tenant in tenants:
+            buckets = bucketsByTenant.get(tenant.tenantId, {})
+            running = dict((column, getMetricDefault(metric) if metric.aggregate != 'max' else None) for column, metric in aggregates.items())
+            records = []
+            for day in range(firstDay - 1, lastDay + 1):
+                for column, value in buckets.get(day, {}).items():
+                    running[column] = mergeIncrementalValue(aggregates[column].aggregate, running[column], value)
+                if day >= firstDay:
+                    records.append([EPOCH_DATE + timedelta(days=day)] + createEntryForRollout(tenant, running) + [createdTime])
+            extras.execute_values(cursor, insertQuery, records, page_size=pageSize)
+            writtenCount += len(records)
+        
+        connection.commit()
+        print(writtenCount, "snapshot rows backfilled")
+        return True
+    
+    except Exception as exception:
+        logException(exception)
+        return False
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+
+# anomaly detection after every published run: the numeric columns of roll_out_dashboard are compared with the
+# tenant's row of the latest earlier snapshot. the day over day change of each cell (log1p(today) - log1p(previous),
+# so a tripled demand count scores the same in a small and a large village) gets a robust z-score against the changes
+# of the other tenants of the same heirarchy group, (change - group median) / (1.4826 * group MAD). the groups of
+# every ANOMALY_LEVELS level are scored in one pass over numpy arrays, groups with less than ANOMALY_MIN_PEERS tenants
+# are scored against the whole state. cells above ANOMALY_Z_THRESHOLD and cells that dropped to zero are written to
+# ANOMALY_REPORT
+ANOMALY_METRIC_COLUMNS = [column for column in ROLLOUT_METRIC_COLUMNS if column not in ROLLOUT_DATE_COLUMNS + ROLLOUT_ROLLUP_EXCLUDED_COLUMNS]
+
+def getGroupCodes(labels, minPeers):
+    # integer group of every tenant and the group count. the tenants of groups that are too small share the last code,
+    # returned as the state code (None when every group is large enough), and are scored against all tenants
+    groupLabels, codes = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(codes)
+    smallGroups = sizes < minPeers
+    if not smallGroups.any():
+        return codes, len(groupLabels), None
+    stateCode = int((~smallGroups).sum())
+    remapped = np.cumsum(~smallGroups) - 1
+    remapped[smallGroups] = stateCode
+    return remapped[codes], stateCode + 1, stateCode
+
+def groupedMedian(values, codes, groupCount):
+    # median of the non nan values of each group, nan for a group without any. the values are sorted by group and
+    # value (nan last within a group) and the middle of each group's valid values is read at its offset
+    order = np.lexsort((values, codes))
+    sortedValues = values[order]
+    sizes = np.bincount(codes, minlength=groupCount)
+    validCounts = np.bincount(codes, weights=~np.isnan(values), minlength=groupCount).astype(int)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    medians = np.full(groupCount, np.nan)
+    hasValues = validCounts > 0
+    low = starts[hasValues] + (validCounts[hasValues] - 1) // 2
+    high = starts[hasValues] + validCounts[hasValues] // 2
+    medians[hasValues] = (sortedValues[low] + sortedValues[high]) / 2
+    return medians
+
+def robustZScores(changes, codes, groupCount, minScale, stateCode=None):
+    # (change - group median) / (1.4826 * group MAD) per column, the scale is kept at minScale or more so a group whose
+    # cells barely moved does not flag every small change. the stateCode group takes the median and MAD of all tenants
+    zScores = np.full(changes.shape, np.nan)
+    medians = np.full(changes.shape, np.nan)
+    stateCodes = np.zeros(len(codes), dtype=int)
+    for index in range(changes.shape[1]):
+        column = changes[:, index]
+        groupMedians = groupedMedian(column, codes, groupCount)
+        groupMads = groupedMedian(np.abs(column - groupMedians[codes]), codes, groupCount)
+        if stateCode is not None:
+            groupMedians[stateCode] = groupedMedian(column, stateCodes, 1)[0]
+            groupMads[stateCode] = groupedMedian(np.abs(column - groupMedians[stateCode]), stateCodes, 1)[0]
+        scales = np.maximum(1.4826 * groupMads, minScale)
+        medians[:, index] = groupMedians[codes]
+        zScores[:, index] = (column - medians[:, index]) / scales[codes]
+    return zScores, medians
+
+@instrumented
+def detectAnomalies():
+    if os.getenv('ANOMALY_DETECTION', 'true').lower() != 'true':
+        return
+    if np is None:
+        print("numpy is not installed, anomaly detection skipped")
+        return
+    levels = [level.strip() for level in os.getenv('ANOMALY_LEVELS', 'division').split(',') if level.strip()]
+    unknownLevels = [level for level in levels if level != 'state' and level not in ROLLOUT_HEIRARCHY_COLUMNS[2:]]
+    if unknownLevels:
+        print("unknown ANOMALY_LEVELS", unknownLevels, ", anomaly detection skipped")
+        return
+    threshold = float(os.getenv('ANOMALY_Z_THRESHOLD', '3.5'))
+    minPeers = int(os.getenv('ANOMALY_MIN_PEERS', '5'))
+    minScale = float(os.getenv('ANOMALY_MIN_SCALE', '0.05'))
+    snapshotDate = datetime.now(tz=pytz.timezone('Asia/Kolkata')).date()
+    
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        cursor.execute("select to_regclass('roll_out_dashboard_snapshot') is not null")
+        previousDate = None
+        if cursor.fetchone()[0]:
+            cursor.execute("select max(snapshot_date) from roll_out_dashboard_snapshot where snapshot_date < %s", (snapshotDate,))
+            previousDate = cursor.fetchone()[0]
+        if previousDate is None:
+            connection.rollback()
+            print("no earlier snapshot, anomaly detection skipped")
+            return
+        cursor.execute("select " + ", ".join("d." + column for column in ROLLOUT_HEIRARCHY_COLUMNS) + ", d.stale_columns, " +
+                       ", ".join("d." + column + "::float8" for column in ANOMALY_METRIC_COLUMNS) + ", " +
+                       ", ".join("s." + column + "::float8" for column in ANOMALY_METRIC_COLUMNS) +
+                       """ from roll_out_dashboard d left join roll_out_dashboard_snapshot s on s.tenantid = d.tenantid
+                       and s.snapshot_date = %s order by d.tenantid""", (previousDate,))
+        rows = cursor.fetchall()
+        connection.rollback()
+    
+    except Exception as exception:
+        logException(exception)
+        return
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+    
+    if not rows:
+        return
+    analysisStart = time.time()
+    heirarchyCount = len(ROLLOUT_HEIRARCHY_COLUMNS)
+    metricCount = len(ANOMALY_METRIC_COLUMNS)
+    values = np.array([row[heirarchyCount + 1:] for row in rows], dtype=float)
+    current = values[:, :metricCount]
+    previous = values[:, metricCount:]
+    # carried forward cells did not move on their own, they are left out like the missing ones
+    for rowIndex, row in enumerate(rows):
+        if row[heirarchyCount]:
+            for column in row[heirarchyCount].split(','):
+                if column in ANOMALY_METRIC_COLUMNS:
+                    current[rowIndex, ANOMALY_METRIC_COLUMNS.index(column)] = np.nan
+    changes = np.log1p(np.maximum(current, 0)) - np.log1p(np.maximum(previous, 0))
+    droppedToZero = (previous > 0) & (current == 0)
+    
+    zScoresByLevel = {}
+    mediansByLevel = {}
+    for level in levels:
+        if level == 'state':
+            labels = np.zeros(len(rows), dtype=int)
+        else:
+            labelIndex = ROLLOUT_HEIRARCHY_COLUMNS.index(level)
+            labels = np.array([row[labelIndex] or '' for row in rows])
+        codes, groupCount, stateCode = getGroupCodes(labels, minPeers)
+        zScoresByLevel[level], mediansByLevel[level] = robustZScores(changes, codes, groupCount, minScale, stateCode)
+    
+    # the level with the largest |z| of a cell is reported
+    zStack = np.stack([zScoresByLevel[level] for level in levels])
+    absoluteZ = np.where(np.isnan(zStack), -1, np.abs(zStack))
+    strongestLevel = absoluteZ.argmax(axis=0)
+    strongestZ = np.take_along_axis(zStack, strongestLevel[None], axis=0)[0]
+    flaggedCells = (np.abs(np.nan_to_num(strongestZ)) >= threshold) | droppedToZero
+    
+    flagged = []
+    for rowIndex, columnIndex in zip(*np.nonzero(flaggedCells)):
+        row = rows[rowIndex]
+        level = levels[strongestLevel[rowIndex, columnIndex]]
+        zScore = strongestZ[rowIndex, columnIndex]
+        entry = dict(zip(ROLLOUT_HEIRARCHY_COLUMNS, row[:heirarchyCount]))
+        entry.update({"metric": ANOMALY_METRIC_COLUMNS[columnIndex],
+                      "previous": float(previous[rowIndex, columnIndex]),
+                      "current": float(current[rowIndex, columnIndex]),
+                      "level": level,
+                      "zScore": None if np.isnan(zScore) else round(float(zScore), 2),
+                      "groupMedianChange": None if np.isnan(zScore) else round(float(np.expm1(mediansByLevel[level][rowIndex, columnIndex])), 4),
+                      "reason": "droppedToZero" if droppedToZero[rowIndex, columnIndex] else "zScore"})
+        flagged.append(entry)
+    flagged.sort(key=lambda entry: (entry["reason"] != "droppedToZero", -abs(entry["zScore"] or 0)))
+    runSummary['anomalies'] = len(flagged)
+    print(len(flagged), "anomalous cells in", len(set(entry["tenantid"] for entry in flagged)), "of", len(rows), "tenants against the snapshot of",
+          previousDate, "(analysed in %.1f ms)" % ((time.time() - analysisStart) * 1000))
+    for entry in flagged[:20]:
+        print("  %-20s %-32s %14s -> %-14s %-10s z %s" % (entry["tenantid"], entry["metric"], entry["previous"], entry["current"], entry["level"],
+                                                         entry["zScore"]))
+    
+    report = {"generatedTime": datetime.now(tz=pytz.timezone('Asia/Kolkata')).isoformat(),
+              "snapshotDate": snapshotDate,
+              "previousSnapshotDate": previousDate,
+              "levels": levels,
+              "zThreshold": threshold,
+              "minPeers": minPeers,
+              "tenantCount": len(rows),
+              "flaggedTenantCount": len(set(entry["tenantid"] for entry in flagged)),
+              "flagged": flagged}
+    reportFile = os.getenv('ANOMALY_REPORT', 'rollout-dashboard-anomalies.json')
+    try:
+        writeFileAtomically(reportFile, json.dumps(report, indent=2, default=str))
+    except IOError as exception:
+        logException(exception, "anomaly report could not be written")
+
+CREATE_RUN_LOG_TABLE_QUERY = """create table if not exists roll_out_dashboard_run_log(
+        id SERIAL primary key,
+        mode varchar(32) NOT NULL,
+        status varchar(16) NOT NULL,
+        starttime TIMESTAMP NOT NULL,
+        endtime TIMESTAMP NOT NULL,
+        duration_seconds NUMERIC(12,3),
+        tenant_count NUMERIC(10),
+        error_count NUMERIC(10),
+        summary JSONB
+        )"""
+
+def escapePrometheusLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def writeFileAtomically(fileName, content):
+    # node_exporter's textfile collector may read at any time, the file is replaced in one rename
+    temporaryFile = fileName + '.tmp'
+    with open(temporaryFile, 'w') as output:
+        output.write(content)
+    os.replace(temporaryFile, fileName)
+
+def writeRunReport(rolloutMode, runStart, published):
+    # report the run instrumentation: METRICS_TEXTFILE gets a prometheus textfile for node_exporter, METRICS_JSON a
+    # json summary including the per tenant timings and a row is added to roll_out_dashboard_run_log
+    runEnd = time.time()
+    status = 'success' if published else 'failed'
+    errorCount = sum(metric["errors"] for metric in runMetrics.values())
+    summary = {
+        "mode": rolloutMode,
+        "status": status,
+        "startTime": runStart,
+        "durationSeconds": round(runEnd - runStart, 3),
+        "tenantCount": runSummary.get('tenantCount', 0),
+        "errorCount": errorCount,
+        "poolCheckouts": len(poolWaitTimes),
+        "poolWaitSeconds": round(sum(poolWaitTimes), 3),
+        "missingIndexes": runSummary.get('missingIndexes', []),
+        "shard": runSummary.get('shard'),
+        "resumedTenants": runSummary.get('resumedTenants', 0),
+        "readFrom": runSummary.get('readFrom', 'primary'),
+        "replicaLagSeconds": runSummary.get('replicaLagSeconds'),
+        "budgetExhausted": runSummary.get('budgetExhausted', False),
+        "heirarchyCached": runSummary.get('heirarchyCached', False),
+        "heirarchyChanges": runSummary.get('heirarchyChanges', {}),
+        "streamEvents": runSummary.get('streamEvents', 0),
+        "streamInvalidEvents": runSummary.get('streamInvalidEvents', 0),
+        "streamSkippedRecords": runSummary.get('streamSkippedRecords', 0),
+        "streamDroppedCounters": runSummary.get('streamDroppedCounters', 0),
+        "streamFlushes": runSummary.get('streamFlushes', 0),
+        "staleCells": runSummary.get('staleCells', 0),
+        "anomalies": runSummary.get('anomalies', 0),
+        "functions": runMetrics
+    }
+    print("run summary:", json.dumps(dict((key, value) for key, value in summary.items() if key not in ("functions", "heirarchyChanges"))))
+    for metricName, metric in sorted(runMetrics.items(), key=lambda item: -item[1]["seconds"]):
+        print("  %-45s calls %6d  seconds %9.3f  rows %8d  errors %d" % (metricName, metric["calls"], metric["seconds"], metric["rows"], metric["errors"]))
+    
+    textFile = os.getenv('METRICS_TEXTFILE')
+    if textFile:
+        modeLabel = 'mode="' + escapePrometheusLabel(rolloutMode) + '"'
+        lines = []
+        for name, field, help in [("rollout_dashboard_function_seconds", "seconds", "Wall time spent in each dashboard metric function during the last run."),
+                                  ("rollout_dashboard_function_calls", "calls", "Calls of each dashboard metric function during the last run."),
+                                  ("rollout_dashboard_function_rows", "rows", "Rows returned by each dashboard metric function during the last run."),
+                                  ("rollout_dashboard_function_errors", "errors", "Errors caught in each dashboard metric function during the last run.")]:
+            lines.append("# HELP " + name + " " + help)
+            lines.append("# TYPE " + name + " gauge")
+            for metricName, metric in sorted(runMetrics.items()):
+                lines.append('%s{%s,function="%s"} %s' % (name, modeLabel, escapePrometheusLabel(metricName), metric[field]))
+        for name, value, help in [("rollout_dashboard_run_duration_seconds", summary["durationSeconds"], "Duration of the last dashboard run."),
+                                  ("rollout_dashboard_run_tenants", summary["tenantCount"], "Tenants processed by the last dashboard run."),
+                                  ("rollout_dashboard_run_errors", errorCount, "Errors caught during the last dashboard run."),
+                                  ("rollout_dashboard_run_success", 1 if published else 0, "Whether the last dashboard run published its result."),
+                                  ("rollout_dashboard_run_end_timestamp_seconds", round(runEnd, 3), "End time of the last dashboard run."),
+                                  ("rollout_dashboard_pool_wait_seconds", summary["poolWaitSeconds"], "Time spent waiting for a pooled connection in the last run."),
+                                  ("rollout_dashboard_missing_indexes", len(summary["missingIndexes"]), "Last activity indexes missing in the last run."),
+                                  ("rollout_dashboard_read_from_replica", 1 if summary["readFrom"] == 'replica' else 0, "Whether the last run read the metrics from the read replica."),
+                                  ("rollout_dashboard_stale_cells", summary["staleCells"], "Cells carried forward from the published dashboard in the last run."),
+                                  ("rollout_dashboard_anomalies", summary["anomalies"], "Cells flagged by the anomaly detection after the last run.")]:
+            lines.append("# HELP " + name + " " + help)
+            lines.append("# TYPE " + name + " gauge")
+            lines.append('%s{%s} %s' % (name, modeLabel, value))
+        try:
+            writeFileAtomically(textFile, "\n".join(lines) + "\n")
+        except IOError as exception:
+            logException(exception, "metrics textfile could not be written")
+    
+    jsonFile = os.getenv('METRICS_JSON')
+    if jsonFile:
+        try:
+            writeFileAtomically(jsonFile, json.dumps(dict(summary, tenants=tenantMetrics), indent=2, default=str))
+        except IOError as exception:
+            logException(exception, "metrics summary could not be written")
+    
+    if os.getenv('RUN_LOG_ENABLED', 'true').lower() != 'true':
+        return
+    connection = None
+    try:
+        connection = getConnection()
+        cursor = connection.cursor()
+        cursor.execute(CREATE_RUN_LOG_TABLE_QUERY)
+        tzInfo = pytz.timezone('Asia/Kolkata')
+        cursor.execute("""INSERT INTO roll_out_dashboard_run_log (mode, status, starttime, endtime, duration_seconds, tenant_count, error_count, summary)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+            (rolloutMode, status, datetime.fromtimestamp(runStart, tz=tzInfo), datetime.fromtimestamp(runEnd, tz=tzInfo), summary["durationSeconds"],
+             summary["tenantCount"], errorCount, json.dumps(summary)))
+        connection.commit()
+    
+    except Exception as exception:
+        logException(exception)
+    
+    finally:
+        if connection:
+            cursor.close()
+            releaseConnection(connection)
+
+        
+# shared connection pools reused by every metric function and the insert path, sized through
+# DB_POOL_MIN_SIZE / DB_POOL_MAX_SIZE so they can be kept within the RDS connection limits. the 'write' pool connects
+# to DB_HOST and takes the roll_out_dashboard DDL and inserts, the 'read' pool connects to DB_READ_HOST (a read
+# replica) and takes the metric queries, DB_READ_* settings default to the DB_* ones
+connectionPools = {}
+connectionPoolLock = threading.Lock()
+poolWaitTimes = []
+
+def getDatabaseSetting(role, name, default=None):
+    if role == 'read' and os.getenv('DB_READ_' + name):
+        return os.getenv('DB_READ_' + name)
+    return os.getenv('DB_' + name, default)
+
+def getConnectionPool(role='write'):
+    # returns the (pool, slots) pair of the role
+    with connectionPoolLock:
+        if role not in connectionPools:
+            minSize = int(getDatabaseSetting(role, 'POOL_MIN_SIZE', '1'))
+            maxSize = int(getDatabaseSetting(role, 'POOL_MAX_SIZE', '5'))
+            
+            connectionPool = pool.ThreadedConnectionPool(minSize, maxSize,
+                                    user=getDatabaseSetting(role, 'USER'),
+                                    password=getDatabaseSetting(role, 'PWD'),
+                                    host=getDatabaseSetting(role, 'HOST'),
+                                    port=getDatabaseSetting(role, 'PORT'),
+                                    database=getDatabaseSetting(role, 'SCHEMA'))
+            # the psycopg2 pool raises instead of blocking when it is exhausted, callers wait on this semaphore
+            connectionPools[role] = (connectionPool, threading.BoundedSemaphore(maxSize))
+    
+    return connectionPools[role]
+
+def getConnection(role='write'):
+    # borrow a connection from the shared pool, waiting for a free slot when all of them are in use
+    connectionPool, connectionPoolSlots = getConnectionPool(role)
+    
+    waitStart = time.time()
+    connectionPoolSlots.acquire()
+    try:
+        connection = connectionPool.getconn()
+    except Exception:
+        connectionPoolSlots.release()
+        raise
+    poolWaitTimes.append(time.time() - waitStart)
+   
+    return connection
+
+def releaseConnection(connection, role='write'):
+    # hand the connection back to the pool, the pool rolls back any transaction left open on it
+    connectionPool, connectionPoolSlots = connectionPools[role]
+    connectionPool.putconn(connection)
+    connectionPoolSlots.release()
+
+def closeConnectionPool():
+    with connectionPoolLock:
+        for connectionPool, _ in connectionPools.values():
+            connectionPool.closeall()
+        connectionPools.clear()
+
+# metric queries go to the read replica only when DB_READ_HOST is set and checkReadReplica() found it close enough
+# to the primary, otherwise they stay on the primary
+readReplicaState = {"active": False, "visibleTime": None}
+
+def getReadRole():
+    return 'read' if readReplicaState['active'] else 'write'
+
+@instrumented
+def checkReadReplica():
+    # measure the replica lag once per run. a replica that has replayed everything it received counts as caught up
+    # even when the primary was idle since its last transaction. a lag above REPLICA_MAX_LAG_SECONDS or an unreachable
+    # replica sends the metric queries to the primary
+    readReplicaState.update(active=False, visibleTime=None)
+    if not os.getenv('DB_READ_HOST'):
+        return None
+    maxLag = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '300'))
+    connection = None
+    try:
+        connection = getConnection('read')
+        cursor = connection.cursor()
+        cursor.execute("""select case when not pg_is_in_recovery() or pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+                                      else coalesce(extract(epoch from now() - pg_last_xact_replay_timestamp()), 0) end""")
+        lagSeconds = float(cursor.fetchone()[0])
+        runSummary['replicaLagSeconds'] = round(lagSeconds, 3)
+        if lagSeconds > maxLag:
+            print("read replica is %.0f seconds behind, metric queries read from the primary" % lagSeconds)
+            return lagSeconds
+        readReplicaState.update(active=True, visibleTime=time.time() - lagSeconds)
+        print("metric queries read from the replica, lag %.1f seconds" % lagSeconds)
+        return lagSeconds
+    
+    except Exception as exception:
+        logException(exception, "read replica could not be checked, metric queries read from the primary")
+        return None
+    
+    finally:
+        if connection:
+            connection.rollback()
+            cursor.close()
+            releaseConnection(connection, 'read')
+        runSummary['readFrom'] = 'replica' if readReplicaState['active'] else 'primary'
+
+def printPoolWaitTimes():
+    # report how long callers waited for a pooled connection so the pool can be sized against the db limits
+    if not poolWaitTimes:
+        return
+    totalWait = sum(poolWaitTimes)
+    print("connection pool checkouts: ", len(poolWaitTimes))
+    print("connection pool wait total(s): %.3f avg(ms): %.3f max(ms): %.3f" % (totalWait, totalWait * 1000 / len(poolWaitTimes), max(poolWaitTimes) * 1000))
+    
+def parseDate(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+def getCurrentDate():
+    currentDate = datetime.today().strftime('%Y-%m-%d')
+    currentDateInMillis = str(parser.parse(currentDate).timestamp() * 1000)
+    
+    return currentDateInMillis
+     
+    
+ROLLOUT_COLUMN_DEFINITIONS = """tenantid varchar(250) NOT NULL,
+        projectcode varchar(66),
+        zone varchar(250),
         circle varchar(250),
         division varchar(250),
         subdivision varchar(250),
@@ -584,12 +2682,61 @@ def createTable():
         ratings_count NUMERIC(10),
         last_rating_date DATE,
         active_users_count NUMERIC(10),
-        total_advance NUMERIC(10),
-        total_penalty NUMERIC(10),
-        createdtime TIMESTAMP NOT NULL
+        total_advance NUMERIC(12,2),
+        total_penalty NUMERIC(12,2),
+        collection_by_payment_mode JSONB,
+        stale_columns TEXT,
+        createdtime TIMESTAMP NOT NULL"""
+
+def createTable(tableName='roll_out_dashboard'):
+    
+    CREATE_TABLE_QUERY = """create table if not exists """ + tableName + """(
+        id SERIAL primary key, 	
+        """ + ROLLOUT_COLUMN_DEFINITIONS + """
         )"""
     
     return CREATE_TABLE_QUERY
+
+def getAddColumnQueries(tableName):
+    # tables created by an older version keep their columns with create table if not exists, add the missing ones
+    # before rows are written to them. decimal columns an older version created with fewer digits after the point
+    # (total_advance and total_penalty were NUMERIC(10)) are widened, incremental runs add to the stored value and a
+    # rounded one would drop the fractions of every delta
+    queries = []
+    for definition in ROLLOUT_COLUMN_DEFINITIONS.split(",\n"):
+        queries.append("alter table " + tableName + " add column if not exists " + definition.strip())
+        decimalColumn = re.match(r"(\w+) NUMERIC\((\d+),\s*(\d+)\)", definition.strip())
+        if decimalColumn:
+            column, precision, scale = decimalColumn.groups()
+            queries.append("""do $$ begin
+                if exists (select 1 from information_schema.columns where table_schema = current_schema() and table_name = '""" + tableName + """'
+                           and column_name = '""" + column + """' and numeric_scale < """ + scale + """) then
+                    alter table """ + tableName + """ alter column """ + column + """ type NUMERIC(""" + precision + """, """ + scale + """);
+                end if;
+            end $$""")
+    return queries
+
+def createSnapshotTable():
+    
+    CREATE_SNAPSHOT_TABLE_QUERY = """create table if not exists roll_out_dashboard_snapshot(
+        snapshot_date DATE NOT NULL,
+        """ + ROLLOUT_COLUMN_DEFINITIONS + """,
+        primary key (tenantid, snapshot_date)
+        ) partition by range (snapshot_date)"""
+    
+    return CREATE_SNAPSHOT_TABLE_QUERY
     
 if __name__ == '__main__':
-    process()
+    argumentParser = argparse.ArgumentParser(description="Build the roll_out_dashboard table")
+    argumentParser.add_argument('--shard', help="collect only shard i of n (e.g. 0/4) into the staging table of the run")
+    argumentParser.add_argument('--merge', type=int, metavar='N', help="publish the run once all N shards are done")
+    argumentParser.add_argument('--run-id', help="id shared by the shards and attempts of a run, defaults to ROLLOUT_RUN_ID or the date")
+    argumentParser.add_argument('--resume', action='store_true', help="skip the tenants already written by an earlier attempt of the run")
+    argumentParser.add_argument('--explain', action='store_true', help="write the query plans of the metric queries to EXPLAIN_REPORT instead of a run")
+    argumentParser.add_argument('--as-of', type=parseDate, metavar='DATE', help="backfill roll_out_dashboard_snapshot with the dashboard as of the end of DATE (YYYY-MM-DD)")
+    argumentParser.add_argument('--to', type=parseDate, metavar='DATE', help="with --as-of, backfill every day up to DATE in the same scans")
+    argumentParser.add_argument('--columns', type=lambda value: [column.strip() for column in value.split(',')],
+                                help="with --as-of, overwrite only these comma separated columns of existing snapshot rows")
+    arguments = argumentParser.parse_args()
+    process(shard=arguments.shard, mergeShardCount=arguments.merge, runId=arguments.run_id, resume=arguments.resume, explain=arguments.explain,
+            asOf=arguments.as_of, asOfTo=arguments.to, columns=arguments.columns)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# Benchmark harness for the rollout dashboard job (app.py).
+#
+# Seeds a local PostgreSQL database with synthetic eg_ws_connection, egcl_payment / egcl_paymentdetail,
+# egbs_demand_v1 / egbs_demanddetail_v1, eg_echallan, eg_ws_feedback and eg_user / eg_userrole_v1 rows for N tenants,
+# serves the MDMS projectmodule and WCBillingSlab masters from a local stub and runs process() in the requested modes.
+# Reports end to end runtime, time per metric function and the number of SQL statements and MDMS calls.
+#
+# The source tables are dropped and recreated, so only point it at a throw away local database:
+#   DB_HOST=localhost DB_SCHEMA=rollout_bench DB_USER=postgres DB_PWD=postgres DB_PORT=5432 python3 benchmark.py --tenants 500
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import psycopg2
+from psycopg2 import extensions
+
+import app
+
+LOCAL_HOSTS = ['localhost', '127.0.0.1', '::1']
+
+SEED_TABLES_QUERY = """
+drop table if exists eg_ws_connection, egcl_payment, egcl_paymentdetail, egbs_demand_v1, egbs_demanddetail_v1,
+    eg_echallan, eg_ws_feedback, eg_user, eg_userrole_v1;
+create table eg_ws_connection (id varchar(64) primary key, tenantid varchar(250) NOT NULL, status varchar(64) NOT NULL, createdtime bigint);
+create table egcl_payment (id varchar(64) primary key, tenantid varchar(64) NOT NULL, paymentmode varchar(64) NOT NULL, createdtime bigint);
+create table egcl_paymentdetail (id varchar(64) primary key, paymentid varchar(64) NOT NULL, tenantid varchar(64) NOT NULL,
+    businessservice varchar(64) NOT NULL, amountpaid numeric(12,2), createdtime bigint);
+create table egbs_demand_v1 (id varchar(64) primary key, tenantid varchar(250) NOT NULL, businessservice varchar(250) NOT NULL,
+    status varchar(64), createdtime bigint);
+create table egbs_demanddetail_v1 (id varchar(64) primary key, demandid varchar(64) NOT NULL, tenantid varchar(250) NOT NULL,
+    taxheadcode varchar(250) NOT NULL, taxamount numeric(12,2), createdtime bigint);
+create table eg_echallan (id varchar(64) primary key, tenantid varchar(64), applicationstatus varchar(64), createdtime bigint);
+create table eg_ws_feedback (id varchar(256) primary key, tenantid varchar(256), createdtime bigint);
+create table eg_user (id bigint primary key, type varchar(50), active boolean);
+create table eg_userrole_v1 (user_id bigint NOT NULL, role_code varchar(50) NOT NULL, role_tenantid varchar(256) NOT NULL);
+create index index_eg_ws_connection_tenantId on eg_ws_connection (tenantid);
+create index idx_egcl_payment_tenantid on egcl_payment (tenantid);
+create index idx_egcl_paymentdetail_tenantid on egcl_paymentdetail (tenantid);
+create index idx_egbs_demand_v1_tenantid on egbs_demand_v1 (tenantid);
+create index idx_egbs_demanddetail_v1_demandid on egbs_demanddetail_v1 (demandid);
+create index idx_eg_echallan_tenantid on eg_echallan (tenantid);
+"""
+
+# every row gets a createdtime spread over the last two years, %(tenants)s tenants named pb.bench<n>
+SEED_DATA_QUERIES = [
+    """insert into eg_ws_connection select 'conn-' || t || '-' || c, 'pb.bench' || t, case when c %% 10 = 0 then 'Inactive' else 'Active' end,
+        %(start)s + (random() * %(span)s)::bigint from generate_series(1, %(tenants)s) t, generate_series(1, %(connections)s) c""",
+    """insert into egcl_payment select 'pay-' || t || '-' || c, 'pb.bench' || t, case when c %% 7 = 0 then 'ONLINE' when c %% 3 = 0 then 'CHEQUE' else 'CASH' end,
+        %(start)s + (random() * %(span)s)::bigint from generate_series(1, %(tenants)s) t, generate_series(1, %(payments)s) c""",
+    """insert into egcl_paymentdetail select 'paydetail-' || p.id, p.id, p.tenantid, case when random() < 0.95 then 'WS' else 'EXPENSE' end,
+        round((random() * 1000)::numeric, 2), p.createdtime from egcl_payment p""",
+    """insert into egbs_demand_v1 select 'demand-' || t || '-' || c, 'pb.bench' || t, 'WS', case when c %% 20 = 0 then 'CANCELLED' else 'ACTIVE' end,
+        %(start)s + (random() * %(span)s)::bigint from generate_series(1, %(tenants)s) t, generate_series(1, %(demands)s) c""",
+    """insert into egbs_demanddetail_v1 select 'detail-' || d.id || '-' || h.code, d.id, d.tenantid, h.code, round((random() * 500)::numeric, 2), d.createdtime
+        from egbs_demand_v1 d, (values ('WS_CHARGE'), ('WS_TIME_PENALTY'), ('WS_ADVANCE_CARRYFORWARD')) h(code)
+        where h.code = 'WS_CHARGE' or abs(hashtext(d.id || h.code)) %% 10 < 3""",
+    """insert into eg_echallan select 'challan-' || t || '-' || c, 'pb.bench' || t, case when c %% 2 = 0 then 'PAID' else 'ACTIVE' end,
+        %(start)s + (random() * %(span)s)::bigint from generate_series(1, %(tenants)s) t, generate_series(1, %(challans)s) c""",
+    """insert into eg_ws_feedback select 'feedback-' || t || '-' || c, 'pb.bench' || t,
+        %(start)s + (random() * %(span)s)::bigint from generate_series(1, %(tenants)s) t, generate_series(1, %(feedbacks)s) c""",
+    """insert into eg_user select t * 1000 + c, 'EMPLOYEE', c %% 5 <> 0 from generate_series(1, %(tenants)s) t, generate_series(1, %(users)s) c""",
+    """insert into eg_userrole_v1 select id, 'EMPLOYEE', 'pb.bench' || (id / 1000) from eg_user"""
+]
+
+statementCounts = {}
+statementLock = threading.Lock()
+
+class CountingCursor(extensions.cursor):
+    # counts every statement app.py sends, keyed by its first keyword
+    def execute(self, query, vars=None):
+        keyword = query.decode('utf-8') if isinstance(query, bytes) else str(query)
+        keyword = keyword.strip().split(None, 1)[0].lower() if keyword.strip() else ''
+        with statementLock:
+            statementCounts[keyword] = statementCounts.get(keyword, 0) + 1
+        return super(CountingCursor, self).execute(query, vars)
+
+def installStatementCounter():
+    # the connection pool of app.py opens its connections through psycopg2.connect, inject the counting cursor there
+    originalConnect = psycopg2.connect
+    def countingConnect(*args, **kwargs):
+        kwargs.setdefault('cursor_factory', CountingCursor)
+        return originalConnect(*args, **kwargs)
+    psycopg2.connect = countingConnect
+
+mdmsCalls = {}
+
+def buildProjectModule(tenantCount):
+    # 5 tenants per section, 4 sections per subdivision, 3 subdivisions per division, 2 divisions per circle, 2 circles per zone
+    zones = {}
+    for index in range(1, tenantCount + 1):
+        section = (index - 1) // 5
+        subdivision = section // 4
+        division = subdivision // 3
+        circle = division // 2
+        zone = circle // 2
+        zoneData = zones.setdefault(zone, {"name": "Zone " + str(zone), "circle": {}})
+        circleData = zoneData["circle"].setdefault(circle, {"name": "Circle " + str(circle), "division": {}})
+        divisionData = circleData["division"].setdefault(division, {"name": "Division " + str(division), "subdivision": {}})
+        subdivisionData = divisionData["subdivision"].setdefault(subdivision, {"name": "Subdivision " + str(subdivision), "section": {}})
+        sectionData = subdivisionData["section"].setdefault(section, {"name": "Section " + str(section), "project": []})
+        sectionData["project"].append({"name": "bench" + str(index), "code": "P" + str(index)})
+    return toMdmsList(zones, ["circle", "division", "subdivision", "section"])
+
+def toMdmsList(nodes, childLevels):
+    # turn the nested dicts built above into the nested lists of the projectmodule master
+    result = []
+    for node in nodes.values():
+        node = dict(node)
+        if childLevels:
+            node[childLevels[0]] = toMdmsList(node[childLevels[0]], childLevels[1:])
+        result.append(node)
+    return result
+
+def startMdmsStub(tenantCount, slabsPerTenant):
+    # local stand in for egov-mdms-service answering the projectmodule and WCBillingSlab searches of app.py
+    projectModule = buildProjectModule(tenantCount)
+
+    class MdmsHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            moduleName = body["MdmsCriteria"]["moduleDetails"][0]["moduleName"]
+            with statementLock:
+                mdmsCalls[moduleName] = mdmsCalls.get(moduleName, 0) + 1
+            if moduleName == "tenant":
+                mdmsRes = {"tenant": {"projectmodule": projectModule}}
+            else:
+                slabs = [{"id": str(index), "buildingType": "RESIDENTIAL", "calculationAttribute": "Flat"} for index in range(slabsPerTenant)]
+                mdmsRes = {"ws-services-calculation": {"WCBillingSlab": slabs}}
+            response = json.dumps({"MdmsRes": mdmsRes}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, format, *args):
+            return
+
+    server = HTTPServer(('127.0.0.1', 0), MdmsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def seedDatabase(arguments):
+    print("seeding", arguments.tenants, "tenants")
+    connection = psycopg2.connect(user=os.getenv('DB_USER'), password=os.getenv('DB_PWD'), host=os.getenv('DB_HOST'),
+                                  port=os.getenv('DB_PORT'), database=os.getenv('DB_SCHEMA'))
+    try:
+        cursor = connection.cursor()
+        cursor.execute(SEED_TABLES_QUERY)
+        end = int(time.time() * 1000) - 3600 * 1000
+        parameters = {"tenants": arguments.tenants, "connections": arguments.connections, "payments": arguments.payments,
+                      "demands": arguments.demands, "challans": arguments.challans, "feedbacks": arguments.feedbacks,
+                      "users": arguments.users, "start": end - 2 * 365 * 24 * 3600 * 1000, "span": 2 * 365 * 24 * 3600 * 1000}
+        for query in SEED_DATA_QUERIES:
+            start = time.time()
+            cursor.execute(query, parameters)
+            print("  %-60s %8d rows %7.2fs" % (query.split('select')[0].strip()[:60], cursor.rowcount, time.time() - start))
+        connection.commit()
+        connection.autocommit = True
+        cursor.execute("vacuum analyze")
+    finally:
+        connection.close()
+
+def resetCounters():
+    statementCounts.clear()
+    mdmsCalls.clear()
+
+def runMode(mode):
+    resetCounters()
+    os.environ['ROLLOUT_MODE'] = mode
+    start = time.time()
+    app.process()
+    elapsed = time.time() - start
+    return {
+        "mode": mode,
+        "seconds": round(elapsed, 3),
+        "statements": dict(statementCounts),
+        "statementTotal": sum(statementCounts.values()),
+        "mdmsCalls": dict(mdmsCalls),
+        # per function timings come from the run instrumentation of app.py
+        "functions": dict((name, {"calls": metric["calls"], "seconds": round(metric["seconds"], 3)}) for name, metric in app.runMetrics.items())
+    }
+
+def printReport(result):
+    print("")
+    print("mode %s: %.2fs end to end, %d statements %s, mdms calls %s" % (result["mode"], result["seconds"], result["statementTotal"],
+                                                                           result["statements"], result["mdmsCalls"]))
+    for name, timing in sorted(result["functions"].items(), key=lambda item: -item[1]["seconds"]):
+        print("  %-55s %7d calls %9.3fs" % (name, timing["calls"], timing["seconds"]))
+
+def main():
+    argumentParser = argparse.ArgumentParser(description="Benchmark the rollout dashboard job against synthetic data")
+    argumentParser.add_argument('--tenants', type=int, default=100)
+    argumentParser.add_argument('--connections', type=int, default=200, help="connections per tenant")
+    argumentParser.add_argument('--payments', type=int, default=400, help="payments per tenant")
+    argumentParser.add_argument('--demands', type=int, default=400, help="demands per tenant")
+    argumentParser.add_argument('--challans', type=int, default=50, help="expense challans per tenant")
+    argumentParser.add_argument('--feedbacks', type=int, default=30, help="ratings per tenant")
+    argumentParser.add_argument('--users', type=int, default=5, help="employees per tenant")
+    argumentParser.add_argument('--slabs', type=int, default=4, help="billing slabs per tenant")
+    argumentParser.add_argument('--modes', default='tenant,bulk,incremental', help="comma separated ROLLOUT_MODE values to run in order")
+    argumentParser.add_argument('--skip-seed', action='store_true', help="reuse the data of the previous run")
+    argumentParser.add_argument('--json', help="write the results to this file")
+    argumentParser.add_argument('--allow-remote', action='store_true', help="allow a DB_HOST other than localhost")
+    arguments = argumentParser.parse_args()
+
+    # a DB_HOST starting with / is the unix socket directory of a local server
+    dbHost = os.getenv('DB_HOST') or ''
+    if dbHost not in LOCAL_HOSTS and not dbHost.startswith('/') and not arguments.allow_remote:
+        sys.exit("benchmark drops and reseeds the source tables, refusing to run against DB_HOST=%s" % dbHost)
+
+    if not arguments.skip_seed:
+        seedDatabase(arguments)
+
+    server = startMdmsStub(arguments.tenants, arguments.slabs)
+    os.environ['API_URL'] = 'http://127.0.0.1:%d/' % server.server_address[1]
+    os.environ['TENANT_ID'] = 'pb'
+    # every run starts with a cold billing slab cache
+    os.environ['BILLING_SLAB_CACHE_FILE'] = os.path.join(tempfile.mkdtemp(), 'billing-slab-cache.json')
+    os.environ['BILLING_SLAB_CACHE_TTL_HOURS'] = '0'
+    installStatementCounter()
+
+    results = []
+    for mode in arguments.modes.split(','):
+        results.append(runMode(mode.strip()))
+    server.shutdown()
+
+    for result in results:
+        printReport(result)
+    if arguments.json:
+        with open(arguments.json, 'w') as report:
+            json.dump({"arguments": vars(arguments), "results": results}, report, indent=2)
+
+if __name__ == '__main__':
+    main()
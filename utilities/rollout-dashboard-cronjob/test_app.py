@@ -0,0 +1,266 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import psycopg2
+
+import app
+import benchmark
+
+np = app.np
+
+# the database tests reseed the source tables with benchmark.py and drop the dashboard tables before every test, so
+# they only run when asked to and against a local throw away database:
+#   ROLLOUT_DB_TESTS=true DB_HOST=localhost DB_SCHEMA=rollout_test DB_USER=postgres DB_PWD=postgres DB_PORT=5432 python3 -m unittest test_app
+DATABASE_TESTS = os.getenv('ROLLOUT_DB_TESTS', 'false').lower() == 'true'
+TEST_TENANTS = 6
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class GroupedMedianTest(unittest.TestCase):
+
+    def testMatchesNanmedianPerGroup(self):
+        generator = np.random.default_rng(7)
+        codes = generator.integers(0, 40, 2000)
+        values = generator.normal(size=2000)
+        values[generator.random(2000) < 0.2] = np.nan
+        expected = [np.nanmedian(values[codes == code]) for code in range(40)]
+        np.testing.assert_allclose(app.groupedMedian(values, codes, 40), expected)
+
+    def testEvenCountAveragesTheMiddleValues(self):
+        values = np.array([4.0, 1.0, 3.0, 2.0, 10.0])
+        codes = np.array([0, 0, 0, 0, 1])
+        np.testing.assert_allclose(app.groupedMedian(values, codes, 2), [2.5, 10.0])
+
+    def testGroupWithoutValuesIsNan(self):
+        values = np.array([1.0, np.nan, np.nan])
+        codes = np.array([0, 1, 1])
+        medians = app.groupedMedian(values, codes, 3)
+        self.assertEqual(medians[0], 1.0)
+        self.assertTrue(np.isnan(medians[1:]).all())
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class GroupCodesTest(unittest.TestCase):
+
+    def testLargeGroupsKeepTheirOwnCode(self):
+        codes, groupCount, stateCode = app.getGroupCodes(np.array(['a', 'b', 'a', 'b']), 2)
+        self.assertEqual(list(codes), [0, 1, 0, 1])
+        self.assertEqual(groupCount, 2)
+        self.assertIsNone(stateCode)
+
+    def testSmallGroupsShareTheStateCode(self):
+        labels = np.array(['big'] * 6 + ['pair'] * 2 + ['solo'])
+        codes, groupCount, stateCode = app.getGroupCodes(labels, 5)
+        self.assertEqual(groupCount, 2)
+        self.assertEqual(stateCode, 1)
+        self.assertEqual(list(codes), [0] * 6 + [1] * 3)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class RobustZScoresTest(unittest.TestCase):
+
+    def testOutlierOfAGroupIsScored(self):
+        changes = np.array([[0.01], [0.02], [0.01], [0.03], [0.02], [1.1]])
+        zScores, medians = app.robustZScores(changes, np.zeros(6, dtype=int), 1, 0.05)
+        self.assertGreater(zScores[5, 0], 3.5)
+        self.assertTrue((np.abs(zScores[:5, 0]) < 3.5).all())
+        np.testing.assert_allclose(medians[:, 0], 0.02)
+
+    def testSmallGroupsAreScoredAgainstTheState(self):
+        # two tenants of a small group jumped, the unchanged tenant of another small group is not an outlier
+        labels = np.array(['big'] * 6 + ['pair'] * 2 + ['solo'])
+        changes = np.array([[0.0]] * 6 + [[2.0], [2.0], [0.0]])
+        codes, groupCount, stateCode = app.getGroupCodes(labels, 5)
+        zScores, _ = app.robustZScores(changes, codes, groupCount, 0.05, stateCode)
+        np.testing.assert_allclose(zScores[6:8, 0], 40.0)
+        self.assertEqual(zScores[8, 0], 0.0)
+        self.assertTrue((zScores[:6, 0] == 0).all())
+
+    def testMissingChangesStayNan(self):
+        changes = np.array([[0.0, np.nan], [0.1, 0.0], [0.0, 0.0]])
+        zScores, _ = app.robustZScores(changes, np.zeros(3, dtype=int), 1, 0.05)
+        self.assertTrue(np.isnan(zScores[0, 1]))
+        self.assertFalse(np.isnan(zScores[1:, :]).any())
+
+
+
+@unittest.skipUnless(DATABASE_TESTS, "set ROLLOUT_DB_TESTS=true to run the database tests")
+class DatabaseTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        dbHost = os.getenv('DB_HOST') or ''
+        if dbHost not in benchmark.LOCAL_HOSTS and not dbHost.startswith('/'):
+            raise unittest.SkipTest("the database tests drop the source tables, refusing to run against DB_HOST=" + dbHost)
+        with contextlib.redirect_stdout(io.StringIO()):
+            benchmark.seedDatabase(argparse.Namespace(tenants=TEST_TENANTS, connections=10, payments=10, demands=10, challans=4, feedbacks=2, users=2))
+        cls.server = benchmark.startMdmsStub(TEST_TENANTS, 2)
+        cls.directory = tempfile.mkdtemp()
+        cls.environment = dict(os.environ)
+        os.environ.update(API_URL='http://127.0.0.1:%d/' % cls.server.server_address[1], TENANT_ID='pb',
+                          BILLING_SLAB_CACHE_FILE=os.path.join(cls.directory, 'billing-slab-cache.json'),
+                          HEIRARCHY_CACHE_FILE=os.path.join(cls.directory, 'heirarchy-cache.json'),
+                          ANOMALY_REPORT=os.path.join(cls.directory, 'anomalies.json'),
+                          EVENT_STREAM_DIR=os.path.join(cls.directory, 'events'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        os.environ.clear()
+        os.environ.update(cls.environment)
+
+    def setUp(self):
+        for (tableName,) in self.execute("select tablename from pg_tables where schemaname = current_schema() and tablename like 'roll_out_dashboard%%'"):
+            self.execute("drop table if exists " + tableName + " cascade")
+        shutil.rmtree(os.environ['EVENT_STREAM_DIR'], ignore_errors=True)
+        os.makedirs(os.environ['EVENT_STREAM_DIR'])
+
+    def execute(self, query, parameters=None):
+        connection = psycopg2.connect(user=os.getenv('DB_USER'), password=os.getenv('DB_PWD'), host=os.getenv('DB_HOST'),
+                                      port=os.getenv('DB_PORT'), database=os.getenv('DB_SCHEMA'))
+        connection.autocommit = True
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query, parameters)
+            return cursor.fetchall() if cursor.description else None
+        finally:
+            connection.close()
+
+    def runMode(self, mode, arguments=None, **environment):
+        # process() with ROLLOUT_MODE and the given settings, returns whether the run published
+        saved = dict((name, os.environ.get(name)) for name in list(environment) + ['ROLLOUT_MODE'])
+        os.environ.update(environment, ROLLOUT_MODE=mode)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                return app.process(**(arguments or {}))
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    def writeEvent(self, topic, payload):
+        with open(os.path.join(os.environ['EVENT_STREAM_DIR'], topic + '.jsonl'), 'a') as events:
+            events.write(json.dumps(payload) + "\n")
+
+    def dashboardRows(self):
+        return self.execute("select " + ", ".join(app.ROLLOUT_HEIRARCHY_COLUMNS + app.ROLLOUT_METRIC_COLUMNS) + " from roll_out_dashboard order by tenantid")
+
+
+class WatermarkTest(DatabaseTestCase):
+
+    def testStreamEventsAreNotCountedAgainByIncrementalRuns(self):
+        self.runMode('bulk')
+        time.sleep(0.05)
+        createdTime = int(time.time() * 1000)
+        self.execute("insert into egcl_payment values ('stream-pay', 'pb.bench1', 'CASH', %s)", (createdTime,))
+        self.execute("insert into egcl_paymentdetail values ('stream-paydetail', 'stream-pay', 'pb.bench1', 'WS', 126.00, %s)", (createdTime,))
+        self.writeEvent('egov.collection.payment-create', {"Payment": {"tenantId": "pb.bench1", "paymentMode": "CASH", "auditDetails": {"createdTime": createdTime},
+                        "paymentDetails": [{"id": "stream-paydetail", "businessService": "WS", "totalAmountPaid": 126.00}]}})
+        self.runMode('stream', STREAM_RUN_SECONDS='0.5', STREAM_FLUSH_SECONDS='0.2', STREAM_POLL_SECONDS='0.05')
+        # the first incremental run ends before the streamed payment, the second one covers it
+        self.runMode('incremental', INCREMENTAL_LAG_MINUTES='10')
+        self.runMode('incremental', INCREMENTAL_LAG_MINUTES='0')
+        refreshed = self.dashboardRows()
+        self.runMode('bulk')
+        self.assertEqual(refreshed, self.dashboardRows())
+
+class IncrementalTest(DatabaseTestCase):
+
+    def testFractionalAmountsAddUp(self):
+        self.runMode('bulk')
+        for index in range(3):
+            time.sleep(0.01)
+            createdTime = int(time.time() * 1000)
+            self.execute("insert into egbs_demand_v1 values (%s, 'pb.bench2', 'WS', 'ACTIVE', %s)", ('fraction-demand-%d' % index, createdTime))
+            self.execute("insert into egbs_demanddetail_v1 values (%s, %s, 'pb.bench2', 'WS_TIME_PENALTY', 0.4, %s)",
+                         ('fraction-detail-%d' % index, 'fraction-demand-%d' % index, createdTime))
+            self.runMode('incremental', INCREMENTAL_LAG_MINUTES='0')
+        refreshed = self.dashboardRows()
+        self.runMode('bulk')
+        self.assertEqual(refreshed, self.dashboardRows())
+
+    def testOlderIntegerColumnsAreWidened(self):
+        self.execute(app.createTable())
+        self.execute("alter table roll_out_dashboard alter column total_penalty type NUMERIC(10)")
+        self.runMode('incremental', INCREMENTAL_LAG_MINUTES='0')
+        self.assertEqual(self.execute("""select numeric_scale from information_schema.columns where table_schema = current_schema()
+            and table_name = 'roll_out_dashboard' and column_name = 'total_penalty'"""), [(2,)])
+
+
+    def testDuplicateTenantRowsOfOlderTablesAreRemoved(self):
+        self.runMode('bulk')
+        published = self.dashboardRows()
+        self.execute("drop index roll_out_dashboard_tenantid_idx")
+        self.execute("""insert into roll_out_dashboard (tenantid, consumer_created_count, createdtime)
+            select tenantid, 999, createdtime - interval '1 day' from roll_out_dashboard""")
+        self.runMode('incremental', INCREMENTAL_LAG_MINUTES='0')
+        self.assertEqual(published, self.dashboardRows())
+
+class HeirarchyTest(DatabaseTestCase):
+
+    def testFailedFetchWithoutCacheFailsTheRun(self):
+        self.assertTrue(self.runMode('bulk'))
+        published = self.dashboardRows()
+        os.remove(os.environ['HEIRARCHY_CACHE_FILE'])
+        for mode, arguments in [('tenant', None), ('bulk', None), ('incremental', None), ('bulk', {"shard": "0/2"}),
+                                ('bulk', {"explain": True}), ('bulk', {"asOf": app.parseDate('2026-01-01')})]:
+            with self.subTest(mode=mode, arguments=arguments):
+                self.assertFalse(self.runMode(mode, arguments, API_URL='http://127.0.0.1:1/'))
+                self.assertEqual(self.execute("select status from roll_out_dashboard_run_log order by id desc limit 1"), [('failed',)])
+        self.assertEqual(published, self.dashboardRows())
+
+    def testStalledMdmsIsBoundedByTheRunBudget(self):
+        self.assertTrue(self.runMode('bulk'))
+        # accepts the connection but never answers
+        with socket.socket() as stalled:
+            stalled.bind(('127.0.0.1', 0))
+            stalled.listen()
+            startedAt = time.time()
+            self.assertTrue(self.runMode('bulk', API_URL='http://127.0.0.1:%d/' % stalled.getsockname()[1],
+                                         RUN_TIME_BUDGET_SECONDS='3', BILLING_SLAB_CACHE_TTL_HOURS='0'))
+            self.assertLess(time.time() - startedAt, 10)
+
+
+class ExplainTest(DatabaseTestCase):
+
+    def testOnlyTheSampledTenantsAreAnalyzed(self):
+        reportFile = os.path.join(self.directory, 'explain.json')
+        for analyzeAll in ['false', 'true']:
+            with self.subTest(analyzeAll=analyzeAll):
+                self.assertTrue(self.runMode('tenant', {"explain": True}, EXPLAIN_REPORT=reportFile, EXPLAIN_ANALYZE_ALL=analyzeAll))
+                with open(reportFile) as report:
+                    entries = json.load(report)["queries"]
+                for entry in entries:
+                    analyzed = entry["form"] != "all" or analyzeAll == 'true'
+                    self.assertEqual((entry["analyzed"], entry["executionMs"] is not None), (analyzed, analyzed))
+
+
+class StaleCellTest(DatabaseTestCase):
+
+    def testStaleCellsKeepTheLiveValue(self):
+        self.runMode('bulk')
+        # the live row moved on after the snapshot was written, like after an incremental run
+        self.execute("update roll_out_dashboard set consumer_created_count = 999 where tenantid = 'pb.bench1'")
+        runSourceQuery = app.runSourceQuery
+        def failingConnections(sourceName, *arguments, **keywordArguments):
+            return None if sourceName == 'eg_ws_connection' else runSourceQuery(sourceName, *arguments, **keywordArguments)
+        with mock.patch.object(app, 'runSourceQuery', failingConnections):
+            self.runMode('bulk')
+        self.assertEqual(self.execute("select consumer_created_count, stale_columns from roll_out_dashboard where tenantid = 'pb.bench1'"),
+                         [(999, 'consumer_created_count')])
+
+
+if __name__ == '__main__':
+    unittest.main()